@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from flask import Flask
+from datetime import timedelta
 
 from tracker import app
 from tracker.cron import scheduler
@@ -21,6 +22,14 @@ if __name__ == '__main__':
     app.config['UPLOAD_FOLDER'] = os.path.join(base_dir, 'uploads/')
     app.config['REPOSITORY_FOLDER'] = os.path.join(base_dir, 'repositories/')
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'
+    app.config['REFRESH_CONCURRENCY'] = 8
+    app.config['REFRESH_PER_HOST'] = 2
+    app.config['REFRESH_MIN_INTERVAL'] = timedelta(minutes=15)
+    app.config['REFRESH_MAX_INTERVAL'] = timedelta(days=7)
+    app.config['CLONE_CONCURRENCY'] = 2
+    app.config['MAINTENANCE_CONCURRENCY'] = 1
+    app.config['MAINTENANCE_MAX_PACKS'] = 20
+    app.config['MAINTENANCE_MAX_LOOSE'] = 1000
     init_db()
     print('Database initialized.')
     scheduler.start()
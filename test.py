@@ -4,16 +4,26 @@ from werkzeug import FileStorage
 from werkzeug.datastructures import MultiDict
 
 from tracker import app
-from tracker.models import db, init_db, User, Repository, Tag, UserEmail
-from tracker.git import GitOperations
+from tracker.models import db, init_db, User, Repository, Tag, UserEmail, CommitStat, \
+    TreeStat, DailyActivity, Mirror, MaintenanceRun, PathStat, commit_shared
+from tracker.git import GitOperations, GitMixin
+from tracker.index import CommitIndex
+from tracker.cron import refresh_repositories, refresh_interval, maintain_repositories
+
+from datetime import date, datetime, timedelta
+from calendar import timegm
 
 import io
 import os
+import gzip
+import time
 import unittest
 import tempfile
 import shutil
+import subprocess
 from json import dumps
 from io import StringIO
+from threading import Thread
 
 class GitTrackerTestCase(unittest.TestCase):
 
@@ -42,6 +52,12 @@ class GitTrackerTestCase(unittest.TestCase):
         User.query.delete()
         UserEmail.query.delete()
         Tag.query.delete()
+        CommitStat.query.delete()
+        TreeStat.query.delete()
+        DailyActivity.query.delete()
+        Mirror.query.delete()
+        MaintenanceRun.query.delete()
+        PathStat.query.delete()
         db.session.commit()
         self.initialize()
 
@@ -77,6 +93,16 @@ class GitTrackerTestCase(unittest.TestCase):
         result = self.app.delete(where, data=data, content_type='application/json')
         return loads(result.data)
 
+    def wait_for_job(self, job_id, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            result = self.get('/jobs/' + job_id)
+            assert result['success']
+            if result['data']['state'] in ['finished', 'failed']:
+                return result['data']
+            time.sleep(0.1)
+        self.fail('job %s did not finish within %ds' % (job_id, timeout))
+
     def tearDown(self):
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])
@@ -99,10 +125,94 @@ class GitTestCase(GitTrackerTestCase):
         ('james@foo:random/testing.git', 'james', 'testing.git'),
         ('git@random-server:random.git', 'git', 'random.git')]
 
+    hosts = [
+        ('git://github.com/rails/rails.git', 'github.com'),
+        ('git@github.com:cantsin/random-repo', 'github.com'),
+        ('ssh://git@bitbucket.org:22/account/reponame.git', 'bitbucket.org'),
+        ('https://foo@BitBucket.org/foo/reponame.git', 'bitbucket.org'),
+        ('james@foo:random/testing.git', 'foo'),
+        ('file:///srv/git/testing.git', ''),
+        ('/srv/git/testing.git', '')]
+
     def test_uri_parse(self):
         for test_repo, test_user, test_name in GitTestCase.repos:
             assert GitOperations.git_uri_parse(test_repo) == (test_user, test_name)
 
+    @staticmethod
+    def day_key(year, month, day):
+        # days are keyed by the following midnight (see GitMixin.day_of).
+        return timegm((date(year, month, day) + timedelta(days=1)).timetuple())
+
+    def test_rebucket(self):
+        key = GitTestCase.day_key
+        # 1970-01-04 was a sunday, 1970-01-05 a monday.
+        histogram = [{'date': key(1970, 1, 4), 'value': 1},
+                     {'date': key(1970, 1, 5), 'value': 2},
+                     {'date': key(1970, 1, 11), 'value': 4},
+                     {'date': key(1970, 1, 31), 'value': 8},
+                     {'date': key(1970, 2, 1), 'value': 16},
+                     {'date': key(1970, 12, 31), 'value': 32},
+                     {'date': key(1971, 1, 1), 'value': 64}]
+        assert GitMixin.rebucket(histogram) == histogram
+        assert GitMixin.rebucket(histogram, 'week') == [{'date': key(1969, 12, 29), 'value': 1},
+                                                        {'date': key(1970, 1, 5), 'value': 6},
+                                                        {'date': key(1970, 1, 26), 'value': 24},
+                                                        {'date': key(1970, 12, 28), 'value': 96}]
+        assert GitMixin.rebucket(histogram, 'month') == [{'date': key(1970, 1, 1), 'value': 15},
+                                                         {'date': key(1970, 2, 1), 'value': 16},
+                                                         {'date': key(1970, 12, 1), 'value': 32},
+                                                         {'date': key(1971, 1, 1), 'value': 64}]
+        assert GitMixin.rebucket(histogram, 'year') == [{'date': key(1970, 1, 1), 'value': 63},
+                                                        {'date': key(1971, 1, 1), 'value': 64}]
+
+    def test_rebucket_commit_times(self):
+        # commits late on the last day of a month or year stay in it.
+        times = [time.mktime(datetime(2014, 12, 31, 23).timetuple()),
+                 time.mktime(datetime(2015, 1, 31, 23).timetuple()),
+                 time.mktime(datetime(2015, 2, 1, 1).timetuple())]
+        histogram = GitMixin.group_times(times)
+        key = GitTestCase.day_key
+        assert GitMixin.rebucket(histogram, 'month') == [{'date': key(2014, 12, 1), 'value': 1},
+                                                         {'date': key(2015, 1, 1), 'value': 1},
+                                                         {'date': key(2015, 2, 1), 'value': 1}]
+        assert GitMixin.rebucket(histogram, 'year') == [{'date': key(2014, 1, 1), 'value': 1},
+                                                        {'date': key(2015, 1, 1), 'value': 2}]
+
+    def test_compact_histogram(self):
+        day = 86400
+        histogram = [{'date': day, 'value': 2},
+                     {'date': 2 * day, 'value': 2},
+                     {'date': 5 * day, 'value': 1}]
+        assert GitMixin.compact(histogram) == {'start': day,
+                                               'resolution': 'day',
+                                               'width': day,
+                                               'values': [[2, 2], [0, 2], [1, 1]]}
+        key = GitTestCase.day_key
+        histogram = GitMixin.rebucket([{'date': key(1970, 1, 31), 'value': 1},
+                                       {'date': key(1970, 4, 30), 'value': 3}], 'month')
+        monthly = GitMixin.compact(histogram, 'month')
+        assert monthly['start'] == key(1970, 1, 1)
+        assert monthly['width'] is None
+        assert monthly['values'] == [[1, 1], [0, 2], [3, 1]]
+        weekly = GitMixin.compact(GitMixin.rebucket([{'date': key(1970, 1, 4), 'value': 1},
+                                                     {'date': key(1970, 1, 18), 'value': 1}],
+                                                    'week'), 'week')
+        assert weekly['start'] == key(1969, 12, 29)
+        assert weekly['values'] == [[1, 1], [0, 1], [1, 1]]
+
+    def test_uri_host(self):
+        for test_repo, test_host in GitTestCase.hosts:
+            assert GitOperations.git_uri_host(test_repo) == test_host
+
+    def test_uri_key(self):
+        spellings = ['git://git@github.com/cantsin/git-tracker',
+                     'https://github.com/cantsin/git-tracker.git',
+                     'ssh://git@GitHub.com/cantsin/git-tracker.git/',
+                     'git@github.com:cantsin/git-tracker.git']
+        keys = set(GitOperations.git_uri_key(spelling) for spelling in spellings)
+        assert keys == set(['github.com/cantsin/git-tracker'])
+        assert GitOperations.git_uri_key('file:///tmp/repo.git') == '/tmp/repo'
+
 class UserTestCase(GitTrackerTestCase):
 
     def test_404(self):
@@ -250,6 +360,8 @@ class RepositoryTestCase(GitTrackerTestCase):
             repo_data = dict(location='git://git@github.com/cantsin/git-tracker.git')
             result = self.post('/repositories', **repo_data)
             assert result['success']
+            job = self.wait_for_job(result['data']['job'])
+            assert job['state'] == 'finished'
 
     def test_get_repositories(self):
         result = self.get('/repositories')
@@ -264,11 +376,36 @@ class RepositoryTestCase(GitTrackerTestCase):
         repo_data = dict(location='https://bitbucket.org/cantsin/empty-repo')
         result = self.post('/repositories', **repo_data)
         assert result['success']
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
 
     def test_add_repository_invalid(self):
         repo_data = dict(location='git://git@github.com/cantsin/_invalid')
         result = self.post('/repositories', **repo_data)
-        assert 'Repository not found.' in result['errors'][0]
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'failed'
+        assert 'Repository not found.' in job['error']
+
+    def test_add_repository_job(self):
+        repo_data = dict(location='https://bitbucket.org/cantsin/empty-repo')
+        result = self.post('/repositories', **repo_data)
+        job = self.wait_for_job(result['data']['job'])
+        assert job['kind'] == 'clone'
+        assert job['state'] == 'finished'
+        assert Repository.query.get(job['result']['repository']).name == 'empty-repo.git'
+
+    def test_add_repository_job_duplicate(self):
+        location = self.make_local_remote(1)
+        first = self.post('/repositories', location=location)
+        second = self.post('/repositories', location=location)
+        jobs = [self.wait_for_job(result['data']['job']) for result in [first, second]]
+        assert sorted(job['state'] for job in jobs) == ['failed', 'finished']
+        assert 'Given repository already exists.' in [job['error'] for job in jobs]
+        assert User.query.first().repositories.filter_by(name='local.git').count() == 1
+
+    def test_view_job_invalid(self):
+        result = self.get('/jobs/invalid')
+        assert '404' in result['error']
 
     def test_add_repository_duplicate(self):
         repo_data = dict(location='git://git@github.com/cantsin/git-tracker')
@@ -290,10 +427,373 @@ class RepositoryTestCase(GitTrackerTestCase):
         assert result['success']
         assert result['data']['histogram'] == []
 
+    def test_view_repository_numstat_cache(self):
+        query = {'commit_count': 5}
+        result = self.get('/repositories/1', query=query)
+        assert result['success']
+        before = self.get('/actions/stats')['data']['numstat']
+        result = self.get('/repositories/1', query=query)
+        assert result['success']
+        after = self.get('/actions/stats')['data']['numstat']
+        assert after['misses'] == before['misses']
+        assert after['hits'] > before['hits']
+
+    def test_shared_stats_race(self):
+        oid = 'a' * 40
+        CommitStat.query.filter_by(oid=oid).delete()
+        db.session.add(CommitStat(oid, 1, 2, 3))
+        db.session.commit()
+        db.session.expunge_all()
+        # a second lookup that missed before the first one committed.
+        db.session.add(CommitStat(oid, 1, 2, 3))
+        commit_shared(CommitStat, [oid])
+        assert CommitStat.query.get(oid).as_tuple() == (1, 2, 3)
+        # rows nobody else stored point at a bug, which is logged.
+        db.session.add(PathStat(oid, 'file.txt', 1, 0))
+        db.session.add(PathStat(oid, 'file.txt', 1, 0))
+        with self.assertLogs(app.logger, 'ERROR'):
+            commit_shared(CommitStat, [oid], CommitStat.has_paths == True)
+        assert PathStat.query.filter_by(oid=oid).count() == 0
+
+    def test_view_repository_statistics_cache(self):
+        result = self.get('/repositories/1')
+        assert result['success']
+        before = self.get('/actions/stats')['data']['statistics']
+        second = self.get('/repositories/1')
+        assert second['data']['histogram'] == result['data']['histogram']
+        after = self.get('/actions/stats')['data']['statistics']
+        assert after['hits'] == before['hits'] + 1
+        assert after['misses'] == before['misses']
+
+    def test_repository_time_index(self):
+        repository = Repository.query.first()
+        index = repository.get_index()
+        assert len(index) > 0
+        assert list(index.times) == sorted(index.times)
+        assert index.refs == repository.get_tips()
+        assert index.first() == repository.get_first_updated()
+        middle = index.times[len(index) // 2]
+        commits = list(repository.commits_between(middle, index.last()))
+        assert all(middle <= commit.commit_time for commit in commits)
+        assert [commit.commit_time for commit in commits] == \
+            [commit_time for commit_time, _ in index.between(middle, index.last(),
+                                                             repository.get_emails())]
+
+    def test_repository_columnar_index(self):
+        repository = Repository.query.first()
+        index = repository.get_index()
+        emails = repository.get_emails()
+        expected = GitMixin.group_times(commit_time for commit_time, _
+                                        in index.between(emails=emails))
+        assert index.day_counts(emails=emails) == \
+            [(entry['date'], entry['value']) for entry in expected]
+        commit = next(repository.get_commits(count=1))
+        numstat = repository.get_numstats([commit])[0]
+        assert index.get_numstat(commit.commit_time, commit.id.raw) == numstat
+        reloaded = CommitIndex(repository.ondisk.path)
+        assert len(reloaded) == len(index)
+        assert reloaded.get_numstat(commit.commit_time, commit.id.raw) == numstat
+
+    def test_repository_handle_pool(self):
+        repository = Repository.query.first()
+        assert repository.ondisk is repository.ondisk
+        reloaded = Repository.query.filter_by(id=repository.id).first()
+        assert reloaded.ondisk is repository.ondisk
+        before = self.get('/actions/stats')['data']['repositories']
+        self.get('/repositories')
+        after = self.get('/actions/stats')['data']['repositories']
+        assert after == before
+        repository.release()
+        assert reloaded.ondisk is not None
+
+    def test_repository_index_pool(self):
+        repository = Repository.query.first()
+        index = repository.get_index()
+        assert repository.get_index() is index
+        repository.release()
+        assert repository.get_index() is not index
+
+    def test_churn(self):
+        churn = GitMixin.churn([[('README.md', 1, 0), ('tracker/git.py', 5, 2)],
+                                [('tracker/git.py', 1, 1), ('tracker/static/app.js', 3, 0)]])
+        assert churn == [{'directory': 'tracker', 'additions': 9, 'deletions': 3, 'commits': 2},
+                         {'directory': '', 'additions': 1, 'deletions': 0, 'commits': 1}]
+        churn = GitMixin.churn([[('tracker/git.py', 1, 1), ('tracker/static/app.js', 3, 0)]],
+                               prefix='tracker/')
+        assert [entry['directory'] for entry in churn] == ['tracker/static', 'tracker']
+
+    def test_view_repository_churn(self):
+        repository = Repository.query.first()
+        result = self.get('/repositories/1/churn')
+        assert result['success']
+        churn = result['data']
+        assert churn['unknown'] == 0
+        assert churn['commit_count'] == repository.get_commit_count()
+        numstats = repository.get_numstats(repository.get_commits())
+        assert sum(entry['additions'] for entry in churn['directories']) == \
+            sum(additions for _, additions, _ in numstats)
+        before = self.get('/actions/stats')['data']['path_stats']
+        result = self.get('/repositories/1/churn', query={'depth': 2})
+        after = self.get('/actions/stats')['data']['path_stats']
+        assert after['misses'] == before['misses']
+        assert after['hits'] == before['hits'] + churn['commit_count']
+        result = self.get('/repositories/1/churn', query={'depth': 0})
+        assert 'Invalid depth.' in result['errors']
+
+    def test_path_stats_type_change(self):
+        location = self.make_local_remote(2)
+        where = location[len('file://'):]
+        git = lambda *args: subprocess.check_output(['git', '-C', where] + list(args))
+        git('rm', '--quiet', 'file-0.txt')
+        os.symlink('file-1.txt', os.path.join(where, 'file-0.txt'))
+        git('add', '--all')
+        git('-c', 'user.name=test', '-c', 'user.email=jtranovich@gmail.com',
+            'commit', '--quiet', '-m', 'symlink')
+        repository = GitOperations.create_repository(User.query.first(), location)
+        repository.update_commit_info()
+        head = repository.ondisk.head.get_object()
+        assert repository.get_path_stats(head) == [('file-0.txt', 1, 1)]
+        assert repository.get_churn()['commit_count'] == 3
+        before = self.get('/actions/stats')['data']['path_stats']
+        churn = repository.get_churn()
+        after = self.get('/actions/stats')['data']['path_stats']
+        assert after['misses'] == before['misses']
+        assert churn['directories'][0]['commits'] == 3
+
+    def test_repository_tree_stats(self):
+        repository = Repository.query.first()
+        head = repository.ondisk.head.get_object()
+        parent = head.parents[0]
+        counts = GitMixin.count_tree(parent.tree)
+        incremental = GitMixin.count_tree_change(parent.tree, head.tree, counts)
+        assert incremental == GitMixin.count_tree(head.tree)
+        assert repository.get_tree_stats() == incremental
+        before = self.get('/actions/stats')['data']['tree_stats']
+        assert repository.get_tree_stats() == incremental
+        after = self.get('/actions/stats')['data']['tree_stats']
+        assert after['hits'] == before['hits'] + 1
+
+    def test_repository_latest_refs(self):
+        repository = Repository.query.first()
+        references = list(repository.get_latest_refs())
+        times = [commit_time for _, _, commit_time in references]
+        assert times == sorted(times, reverse=True)
+        assert list(repository.get_latest_refs(count=3)) == references[:3]
+        snapshot = repository.get_ref_snapshot()
+        assert snapshot.fingerprint == snapshot.current_fingerprint()
+
+    def test_view_repository_cursor(self):
+        query = {'commit_count': 3}
+        first = self.get('/repositories/1', query=query)['data']
+        assert len(first['commits']) == 3
+        assert first['next_cursor']
+        query['cursor'] = first['next_cursor']
+        second = self.get('/repositories/1', query=query)['data']
+        everything = self.get('/repositories/1', query={'commit_count': 6})['data']
+        assert first['commits'] + second['commits'] == everything['commits']
+        times = [commit['commit_time'] for commit in everything['commits']]
+        assert times == sorted(times, reverse=True)
+
+    def test_view_repository_stream(self):
+        query = {'commit_count': 5}
+        result = self.get('/repositories/1', query=query)
+        query['stream'] = 1
+        streamed = self.get('/repositories/1', query=query)
+        assert streamed['data']['commits'] == result['data']['commits']
+        assert streamed['data']['histogram'] == result['data']['histogram']
+
+    def test_view_repository_cursor_invalid(self):
+        result = self.get('/repositories/1', query={'cursor': 'not a cursor'})
+        assert 'Invalid cursor.' in result['errors']
+
     def test_delete_repository(self):
         result = self.delete('/repositories/1')
         assert result['success']
 
+    def test_shared_mirror(self):
+        repository = Repository.query.first()
+        other = User('someone@else.org', 'test').save()
+        shared = GitOperations.create_repository(other, 'https://github.com/cantsin/git-tracker.git')
+        assert shared.get_path() == repository.get_path()
+        assert shared.ondisk is repository.ondisk
+        assert Mirror.query.one().refcount == 2
+        results = refresh_repositories([(repository.id, repository.location),
+                                        (shared.id, shared.location)])
+        assert all(result['success'] for result in results)
+        shared.delete()
+        assert Mirror.query.one().refcount == 1
+        assert os.path.exists(repository.get_path())
+        result = self.delete('/repositories/1')
+        assert result['success']
+        assert Mirror.query.count() == 0
+        assert not os.path.exists(repository.get_path())
+
+    def test_delete_repository_mirror_lock(self):
+        location = self.make_local_remote(1)
+        repository = GitOperations.create_repository(User.query.first(), location)
+        repository_id, path = repository.id, repository.get_path()
+        def delete():
+            Repository.query.get(repository_id).delete()
+            db.session.remove()
+        with GitOperations.mirror_lock(location):
+            thread = Thread(target=delete)
+            thread.start()
+            thread.join(0.5)
+            # a clone of the remote holds the lock: the mirror stays.
+            assert thread.is_alive()
+            assert os.path.exists(path)
+        thread.join()
+        assert Repository.query.get(repository_id) is None
+        assert not os.path.exists(path)
+
+    def make_local_remote(self, commits):
+        where = os.path.abspath('test/remotes/local')
+        git = lambda *args: subprocess.check_output(['git', '-C', where] + list(args))
+        if not os.path.exists(where):
+            os.makedirs(where)
+            git('init', '--quiet', '--initial-branch=main')
+        for i in range(commits):
+            with open(os.path.join(where, 'file-%d.txt' % i), 'a') as f:
+                f.write('line %d\n' % i)
+            git('add', '--all')
+            git('-c', 'user.name=test', '-c', 'user.email=jtranovich@gmail.com',
+                'commit', '--quiet', '-m', 'commit %d' % i)
+        return 'file://' + where
+
+    def test_shared_mirror_access(self):
+        location = self.make_local_remote(1)
+        repository = GitOperations.create_repository(User.query.first(), location)
+        repository.update_commit_info()
+        other = User('someone@else.org', 'test').save()
+        shared = GitOperations.create_repository(other, location)
+        shared.update_commit_info()
+        indexed = shared.indexed_refs
+        # the same mirror key, but a remote this user can no longer read.
+        shared.location = location + '.git'
+        shared.save()
+        self.make_local_remote(1)
+        results = refresh_repositories([(repository.id, repository.location),
+                                        (shared.id, shared.location)])
+        assert results[0]['success']
+        assert results[1]['success'] == False
+        assert Repository.query.get(repository.id).get_commit_count() == 2
+        shared = Repository.query.get(shared.id)
+        assert shared.indexed_refs == indexed
+        assert shared.refresh_failures == 1
+
+    def test_shared_mirror_refspecs(self):
+        location = self.make_local_remote(1)
+        where = location[len('file://'):]
+        subprocess.check_output(['git', '-C', where, 'update-ref', 'refs/pull/1/head', 'HEAD'])
+        repository = GitOperations.create_repository(User.query.first(), location)
+        repository.update_commit_info()
+        other = User('someone@else.org', 'test').save()
+        shared = GitOperations.create_repository(other, location)
+        shared.set_refspecs(['+refs/pull/*/head:refs/remotes/origin/pr/*'])
+        shared.save()
+        results = refresh_repositories([(repository.id, repository.location),
+                                        (shared.id, shared.location)])
+        assert all(result['success'] for result in results)
+        assert results[0]['transfer'] is not None
+        assert results[1]['transfer'] is None
+        references = Repository.query.get(shared.id).ondisk.listall_references()
+        assert 'refs/remotes/origin/pr/1' in references
+        assert 'refs/remotes/origin/main' in references
+
+    def test_add_repository_metadata(self):
+        location = self.make_local_remote(3)
+        result = self.post('/repositories', location=location, mode='metadata')
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
+        repository = Repository.query.get(job['result']['repository'])
+        assert repository.mode == 'metadata'
+        head = repository.ondisk.head.get_object()
+        assert head.tree['file-0.txt'].id not in repository.ondisk
+        result = self.get('/repositories/%d' % repository.id)
+        assert result['data']['commit_count'] == 3
+        assert result['data']['file_count'] is None
+        assert result['data']['line_count'] is None
+        assert all(commit['additions'] is None for commit in result['data']['commits'])
+        self.make_local_remote(1)
+        repository.refresh()
+        repository.update_commit_info()
+        assert repository.get_commit_count() == 4
+
+    def test_refresh_default_branch(self):
+        location = self.make_local_remote(2)
+        repository = GitOperations.create_repository(User.query.first(), location)
+        repository.update_commit_info()
+        assert repository.get_default_branch() == 'main'
+        assert repository.get_tracked_refs() == ['refs/heads/main']
+        assert repository.get_commit_count() == 2
+        transfer = repository.refresh()
+        assert transfer['received_objects'] == 0
+        self.make_local_remote(1)
+        result = self.get('/actions/refresh/%d' % repository.id)
+        assert result['data']['transfer']['received_objects'] > 0
+        assert Repository.query.get(repository.id).get_commit_count() == 3
+
+    def test_activity_after_email_change(self):
+        location = self.make_local_remote(2)
+        other = User('someone@else.org', 'test').save()
+        repository = GitOperations.create_repository(other, location)
+        repository.update_commit_info()
+        assert repository.activity.count() == 0
+        # the clone moves on before this repository is re-indexed.
+        self.make_local_remote(1)
+        repository.refresh()
+        other.add_emails('jtranovich@gmail.com')
+        repository = Repository.query.get(repository.id)
+        repository.update_commit_info()
+        assert sum(activity.count for activity in repository.activity) == 3
+
+    def test_repository_branches(self):
+        location = self.make_local_remote(2)
+        where = location[len('file://'):]
+        git = lambda *args: subprocess.check_output(['git', '-C', where] + list(args))
+        git('checkout', '--quiet', '-b', 'feature')
+        self.make_local_remote(1)
+        git('branch', 'release/1', 'main')
+        git('checkout', '--quiet', 'main')
+        repository = GitOperations.create_repository(User.query.first(), location)
+        repository.update_commit_info()
+        assert repository.get_commit_count() == 2
+        url = '/repositories/%d/branches' % repository.id
+        result = self.put(url, branches=['*'])
+        assert sorted(result['data']['tracked_refs']) == ['refs/heads/main',
+                                                          'refs/remotes/origin/feature',
+                                                          'refs/remotes/origin/release/1']
+        repository = Repository.query.get(repository.id)
+        # shared history is counted once.
+        assert repository.get_commit_count() == 3
+        assert len(list(repository.get_commits())) == 3
+        assert sum(count for _, count in repository.day_counts(None, None)) == 3
+        assert sum(activity.count for activity in repository.activity) == 3
+        result = self.put(url, branches=['release/*'])
+        assert result['data']['tracked_refs'] == ['refs/heads/main',
+                                                  'refs/remotes/origin/release/1']
+        assert Repository.query.get(repository.id).get_commit_count() == 2
+        result = self.put(url, branches=[])
+        assert result['data']['branches'] is None
+        for branches in ['release/*', ['main', ''], {'main': True}]:
+            result = self.put(url, branches=branches)
+            assert 'Invalid branches.' in result['errors']
+
+    def test_repository_refspecs(self):
+        refspecs = ['+refs/heads/release/*:refs/remotes/origin/release/*']
+        result = self.put('/repositories/1/refspecs', refspecs=refspecs)
+        assert result['data']['refspecs'] == refspecs
+        assert GitOperations.fetch_refspecs(refspecs, 'master') == \
+            refspecs + ['+refs/heads/master:refs/remotes/origin/master']
+        result = self.put('/repositories/1/refspecs', refspecs=['+refs/*:refs/*'])
+        assert 'Invalid refspecs.' in result['errors']
+        result = self.put('/repositories/1/refspecs', refspecs=[])
+        assert result['data']['refspecs'] is None
+
+    def test_add_repository_invalid_mode(self):
+        result = self.post('/repositories', location='git://example.com/x', mode='shallow')
+        assert 'Invalid mode.' in result['errors']
+
     def test_delete_repository_invalid(self):
         result = self.delete('/repositories/9999')
         assert '404' in result['error']
@@ -385,6 +885,8 @@ class TagTestCase(GitTrackerTestCase):
         repo_data = dict(location='git://git@github.com/cantsin/git-tracker')
         result = self.post('/repositories', **repo_data)
         assert result['success']
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
         # add associated email.
         email_data = dict(email='jtranovich@gmail.com')
         result = self.post('/emails', **email_data)
@@ -428,11 +930,98 @@ class ActivityTestCase(GitTrackerTestCase):
             repo_data = dict(location='git://git@github.com/cantsin/git-tracker')
             result = self.post('/repositories', **repo_data)
             assert result['success']
+            job = self.wait_for_job(result['data']['job'])
+            assert job['state'] == 'finished'
 
     def test_activity(self):
         result = self.get('/activity')
         assert result['success']
 
+    def test_activity_histogram(self):
+        result = self.get('/activity')
+        assert result['success']
+        histogram = result['data']['histogram']
+        repository = Repository.query.first()
+        assert sum(day['value'] for day in histogram) == repository.get_commit_count()
+        dates = [day['date'] for day in histogram]
+        assert dates == sorted(set(dates))
+
+    def test_activity_rollup(self):
+        repository = Repository.query.first()
+        assert sum(day.count for day in repository.activity) == repository.get_commit_count()
+        # without the matching email there is no activity left.
+        email = UserEmail.query.filter_by(email='jtranovich@gmail.com').first()
+        result = self.delete('/emails/%d' % email.id)
+        assert result['success']
+        assert repository.activity.count() == 0
+        result = self.get('/activity')
+        assert result['data']['histogram'] == []
+
+    def test_activity_resolution(self):
+        daily = self.get('/activity')['data']['histogram']
+        total = sum(day['value'] for day in daily)
+        for resolution in ['week', 'month', 'year']:
+            result = self.get('/activity', query={'resolution': resolution})
+            assert result['success']
+            histogram = result['data']['histogram']
+            assert sum(bucket['value'] for bucket in histogram) == total
+            assert len(histogram) <= len(daily)
+
+    def test_activity_resolution_invalid(self):
+        result = self.get('/activity', query={'resolution': 'decade'})
+        assert 'Invalid resolution.' in result['errors']
+
+    def test_activity_etag(self):
+        first = self.app.get('/activity')
+        etag = first.headers['ETag']
+        assert etag
+        second = self.app.get('/activity', headers={'If-None-Match': etag})
+        assert second.status_code == 304
+        assert second.get_data() == b''
+        # a new email changes what the response depends on.
+        result = self.post('/emails', **dict(email='another@some.org'))
+        assert result['success']
+        third = self.app.get('/activity', headers={'If-None-Match': etag})
+        assert third.status_code == 200
+        assert third.headers['ETag'] != etag
+
+    def test_activity_etag_without_git(self):
+        first = self.app.get('/activity')
+        before = self.get('/actions/stats')['data']['repositories']
+        second = self.app.get('/activity', headers={'If-None-Match': first.headers['ETag']})
+        assert second.status_code == 304
+        self.app.get('/activity', query_string={'resolution': 'week'})
+        after = self.get('/actions/stats')['data']['repositories']
+        assert after == before
+
+    def test_activity_stream(self):
+        result = self.get('/activity')
+        streamed = self.app.get('/activity', query_string={'stream': 1})
+        assert streamed.is_streamed
+        assert loads(streamed.get_data()) == result
+
+    def test_activity_compact(self):
+        histogram = self.get('/activity')['data']['histogram']
+        result = self.get('/activity', query={'histogram': 'compact'})
+        compact = result['data']['histogram']
+        assert compact['start'] == histogram[0]['date']
+        assert compact['width'] == 86400
+        assert sum(value * run for value, run in compact['values']) == \
+            sum(day['value'] for day in histogram)
+        assert sum(run for _, run in compact['values']) == \
+            (histogram[-1]['date'] - histogram[0]['date']) // 86400 + 1
+
+    def test_activity_compact_gzip(self):
+        headers = {'Accept': 'application/vnd.git-tracker.compact+json',
+                   'Accept-Encoding': 'gzip'}
+        response = self.app.get('/activity', headers=headers)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        result = loads(gzip.decompress(response.get_data()).decode('utf-8'))
+        assert result['data']['histogram']['resolution'] == 'day'
+        cached = self.app.get('/activity', headers=headers)
+        assert cached.headers['Content-Encoding'] == 'gzip'
+        assert cached.get_data() == response.get_data()
+
     def test_activity_params(self):
         result = self.get('/activity', query={'start': 0, 'end': 9999})
         assert result['success']
@@ -458,11 +1047,78 @@ class ActionTestCase(GitTrackerTestCase):
             repo_data = dict(location='git://git@github.com/cantsin/git-tracker')
             result = self.post('/repositories', **repo_data)
             assert result['success']
+            job = self.wait_for_job(result['data']['job'])
+            assert job['state'] == 'finished'
 
     def test_action_refresh(self):
         result = self.get('/actions/refresh/1')
         assert result['success']
 
+    def test_action_refresh_records_tips(self):
+        result = self.get('/actions/refresh/1')
+        assert result['success']
+        repository = Repository.query.first()
+        indexed = repository.get_indexed_refs()
+        assert 'refs/heads/master' in indexed
+        assert indexed == repository.get_tips()
+
+    def test_action_refresh_unchanged(self):
+        repository = Repository.query.first()
+        first_commit = repository.first_commit
+        last_commit = repository.last_commit
+        result = self.get('/actions/refresh/1')
+        assert result['success']
+        repository = Repository.query.first()
+        assert repository.first_commit == first_commit
+        assert repository.last_commit == last_commit
+
+    def test_refresh_repositories(self):
+        repository = Repository.query.first()
+        missing = (9999, repository.location)
+        results = refresh_repositories([(repository.id, repository.location), missing])
+        assert results[0]['success']
+        assert results[1]['success'] == False
+        assert results[1]['error']
+        assert all(result['duration'] >= 0 for result in results)
+
+    def test_refresh_schedule(self):
+        repository = Repository.query.first()
+        results = refresh_repositories([(repository.id, repository.location)])
+        assert results[0]['success']
+        repository = Repository.query.first()
+        assert repository.refresh_failures == 0
+        assert repository.next_refresh > datetime.now()
+
+    def test_maintain_repositories(self):
+        path = Repository.query.first().get_path()
+        run_id, = maintain_repositories([path])
+        run = MaintenanceRun.query.get(run_id)
+        assert not run.repacked
+        assert run.packs_after == run.packs_before
+        app.config['MAINTENANCE_MAX_PACKS'] = 0
+        try:
+            run_id, = maintain_repositories([path])
+        finally:
+            del app.config['MAINTENANCE_MAX_PACKS']
+        run = MaintenanceRun.query.get(run_id)
+        assert run.repacked
+        assert run.packs_after == 1
+        assert run.loose_after == 0
+        assert Repository.query.first().get_commit_count() > 0
+
+    def test_refresh_interval(self):
+        now = datetime.now()
+        shortest, longest = timedelta(minutes=15), timedelta(days=7)
+        active = refresh_interval(now - timedelta(hours=1), 0, now)
+        recent = refresh_interval(now - timedelta(days=5), 0, now)
+        dormant = refresh_interval(now - timedelta(days=2000), 0, now)
+        assert active == shortest
+        assert shortest < recent < longest
+        assert dormant == longest
+        failing = [refresh_interval(now, failures, now) for failures in range(1, 4)]
+        assert failing == [shortest * 2, shortest * 4, shortest * 8]
+        assert refresh_interval(now, 100, now) == longest
+
     def test_action_refresh_invalid(self):
         result = self.get('/actions/refresh/9999')
         assert '404' in result['error']
@@ -477,6 +1133,10 @@ class ActionTestCase(GitTrackerTestCase):
         files = {'bulk-upload': (io.BytesIO(csv_data), 'test.csv') }
         result = self.post_files('/actions/load', files)
         assert result['success']
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
+        assert job['result']['rows'][0]['status'] == 'exists'
+        assert job['result']['rows'][0]['repository'] == 1
 
     def test_action_load_with_tags(self):
         u = User.query.first()
@@ -486,6 +1146,10 @@ class ActionTestCase(GitTrackerTestCase):
         files = {'bulk-upload': (io.BytesIO(csv_data), 'test.csv') }
         result = self.post_files('/actions/load', files)
         assert result['success']
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
+        repository = Repository.query.first()
+        assert sorted(tag.name for tag in repository.tags) == ['analytics', 'metrics']
 
     def test_action_load_repos_with_tags(self):
         u = User.query.first()
@@ -496,11 +1160,48 @@ class ActionTestCase(GitTrackerTestCase):
         files = {'bulk-upload': (io.BytesIO(csv_data), 'test.csv') }
         result = self.post_files('/actions/load', files)
         assert result['success']
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
+        rows = job['result']['rows']
+        assert [row['status'] for row in rows] == ['exists', 'created']
+        repository = Repository.query.get(rows[1]['repository'])
+        assert repository.tags == []
+
+    def test_action_load_new_tag(self):
+        csv_data = b'empty,https://bitbucket.org/cantsin/empty-repo,bitbucket,new-tag'
+        files = {'bulk-upload': (io.BytesIO(csv_data), 'test.csv') }
+        result = self.post_files('/actions/load', files)
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
+        repository = Repository.query.get(job['result']['rows'][0]['repository'])
+        assert [tag.name for tag in repository.tags] == ['new-tag']
+        assert User.query.first().tags.filter_by(name='new-tag').count() == 1
+
+    def test_action_load_partial_failure(self):
+        csv_data = b'empty,https://bitbucket.org/cantsin/empty-repo,bitbucket,\n' + \
+                   b'invalid,git://git@github.com/cantsin/_invalid,github,'
+        files = {'bulk-upload': (io.BytesIO(csv_data), 'test.csv') }
+        result = self.post_files('/actions/load', files)
+        assert result['success']
+        job = self.wait_for_job(result['data']['job'])
+        assert job['state'] == 'finished'
+        rows = job['result']['rows']
+        assert [row['status'] for row in rows] == ['created', 'failed']
+        assert 'Repository not found.' in rows[1]['error']
 
     def test_action_load_wrong_csv(self):
         files = {'bulk-upload': (io.BytesIO(b'what,the,hey'), 'test.csv') }
         result = self.post_files('/actions/load', files)
         assert 'Invalid format.' in result['errors']
+        assert 'Row 1: expected 4 columns.' in result['errors']
+
+    def test_action_load_validates_first(self):
+        csv_data = b'empty,https://bitbucket.org/cantsin/empty-repo,bitbucket,\n' + \
+                   b'what,the,hey'
+        files = {'bulk-upload': (io.BytesIO(csv_data), 'test.csv') }
+        result = self.post_files('/actions/load', files)
+        assert 'Row 2: expected 4 columns.' in result['errors']
+        assert Repository.query.count() == 1
 
     def test_action_load_invalid(self):
         files = {'bulk-upload': (io.BytesIO(b'invalid'), '')}
@@ -0,0 +1,93 @@
+# pylint: disable=C0103,C0111
+
+from collections import OrderedDict
+from threading import Lock
+
+class CacheStats(object):
+    '''Hit and miss counters for a named cache.'''
+
+    registry = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        CacheStats.registry[name] = self
+
+    def hit(self, count=1):
+        with self.lock:
+            self.hits += count
+
+    def miss(self, count=1):
+        with self.lock:
+            self.misses += count
+
+    def as_dict(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def report():
+        return {name: stats.as_dict()
+                for name, stats in CacheStats.registry.items()}
+
+numstat_stats = CacheStats('numstat')
+tree_stats = CacheStats('tree_stats')
+path_stats = CacheStats('path_stats')
+
+class LRUCache(object):
+    '''A size-bounded mapping that evicts the least recently used entry.'''
+
+    def __init__(self, name, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.stats = CacheStats(name)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.stats.miss()
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hit()
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def pop(self, key):
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+statistics_cache = LRUCache('statistics', 64)
+
+response_cache = LRUCache('responses', 256)
+
+# open pygit2 handles keyed by path; keeping hot repositories open keeps
+# their object caches warm between requests.
+repository_pool = LRUCache('repositories', 128)
+
+# open commit indexes keyed by clone path (then by set of tracked
+# references); every index keeps a file descriptor per mapped column.
+index_pool = LRUCache('indexes', 64)
+
+# bumped whenever something a user's responses depend on changes outside
+# of git (emails, tags, repositories), so that cached responses are not
+# reused for that user.
+generations = {}
+
+def invalidate(user_id):
+    generations[user_id] = generations.get(user_id, 0) + 1
+
+def generation(user_id):
+    return generations.get(user_id, 0)
@@ -1,12 +1,180 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from threading import RLock, Event
 from pytz import utc
+import time
 
-from .models import Repository
+from tracker import app
+from .models import db, Repository, MaintenanceRun
+from .git import GitOperations, GitException
 
 scheduler = BackgroundScheduler(timezone=utc)
 
-@scheduler.scheduled_job('interval', hours=2)
+# the outcome of the last sweep: one entry per repository.
+refresh_report = []
+
+def refresh_interval(last_commit, failures, now):
+    '''How long to wait before refreshing a repository again.
+
+    A repository is refreshed after a fraction of the time it has been
+    idle, so a repository committed to an hour ago is checked within
+    minutes while one untouched for years is checked weekly. Remotes that
+    keep failing back off exponentially.'''
+    shortest = app.config.get('REFRESH_MIN_INTERVAL', timedelta(minutes=15))
+    longest = app.config.get('REFRESH_MAX_INTERVAL', timedelta(days=7))
+    if failures:
+        interval = shortest * 2 ** min(failures, 16)
+    elif last_commit:
+        interval = (now - last_commit) * app.config.get('REFRESH_ACTIVITY_FACTOR', 0.1)
+    else:
+        interval = longest
+    return min(max(interval, shortest), longest)
+
+def refresh_repository(repository_id, fetched=None):
+    '''Refresh a single repository with a session of its own, so that a
+    slow or failing remote only affects its own worker. Clones whose path
+    is in `fetched` were already fetched during this sweep; the user's
+    credentials are still checked against the remote before re-indexing.'''
+    started = time.time()
+    result = {'id': repository_id, 'success': True, 'error': None, 'transfer': None}
+    try:
+        try:
+            repository = Repository.query.get(repository_id)
+            path = repository.get_path()
+            if fetched is None or path not in fetched:
+                result['transfer'] = repository.refresh()
+                if fetched is not None:
+                    fetched.add(path)
+            else:
+                repository.check_access()
+            repository.update_commit_info()
+            repository.refresh_failures = 0
+        except Exception as e: # pylint: disable=W0703
+            db.session.rollback()
+            result.update(success=False, error=str(e))
+            repository = Repository.query.get(repository_id)
+            if repository:
+                repository.refresh_failures = (repository.refresh_failures or 0) + 1
+        if repository:
+            now = datetime.now()
+            repository.next_refresh = now + refresh_interval(repository.last_commit,
+                                                             repository.refresh_failures,
+                                                             now)
+            repository.save()
+    finally:
+        db.session.remove()
+    result['duration'] = time.time() - started
+    return result
+
+def refresh_remote(repository_ids):
+    '''Refresh repositories that track the same remote one after another,
+    so that a shared mirror is fetched once per sweep, with the refspecs
+    of all of its repositories. Should the fetch fail with one user's
+    credentials, the next user's are tried.'''
+    fetched = set()
+    return [refresh_repository(repository_id, fetched)
+            for repository_id in repository_ids]
+
+def refresh_repositories(repositories):
+    '''Refresh (id, location) pairs concurrently, grouped by remote. At
+    most REFRESH_CONCURRENCY remotes are fetched at once, and at most
+    REFRESH_PER_HOST of them from the same git server. A host's next
+    remote is only submitted once one of its slots frees up, so remotes
+    waiting for a busy host never hold a worker.'''
+    concurrency = app.config.get('REFRESH_CONCURRENCY', 8)
+    per_host = app.config.get('REFRESH_PER_HOST', 2)
+    remotes = OrderedDict()
+    for repository_id, location in repositories:
+        remotes.setdefault(GitOperations.git_uri_key(location), []).append(repository_id)
+    hosts = OrderedDict()
+    for position, (key, repository_ids) in enumerate(remotes.items()):
+        hosts.setdefault(key.partition('/')[0], deque()).append((position, repository_ids))
+    outcomes = [[] for _ in remotes]
+    pending = [len(remotes)]
+    # reentrant: a callback runs in place if its future is already done.
+    lock, done = RLock(), Event()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def submit(host):
+            # called with `lock` held.
+            position, repository_ids = hosts[host].popleft()
+            future = executor.submit(refresh_remote, repository_ids)
+            future.add_done_callback(lambda future: finished(host, position, future))
+        def finished(host, position, future):
+            try:
+                outcomes[position] = future.result()
+            finally:
+                with lock:
+                    if hosts[host]:
+                        submit(host)
+                    pending[0] -= 1
+                    if not pending[0]:
+                        done.set()
+        with lock:
+            for host, queued in hosts.items():
+                for _ in range(min(per_host, len(queued))):
+                    submit(host)
+            if not pending[0]:
+                done.set()
+        done.wait()
+    results = [result for outcome in outcomes for result in outcome]
+    for result in results:
+        if result['success']:
+            transfer = result['transfer'] or {'received_objects': 0, 'received_bytes': 0}
+            app.logger.info('refreshed repository %d in %.2fs (%d objects, %d bytes)',
+                            result['id'], result['duration'],
+                            transfer['received_objects'], transfer['received_bytes'])
+        else:
+            app.logger.warning('failed to refresh repository %d after %.2fs: %s',
+                               result['id'], result['duration'], result['error'])
+    return results
+
+def maintain_clone(path):
+    '''Repack a clone once it has more than MAINTENANCE_MAX_PACKS packs or
+    MAINTENANCE_MAX_LOOSE loose objects, and record its metrics.'''
+    started = time.time()
+    try:
+        before = GitOperations.object_counts(path)
+        after, repacked = before, False
+        if before['packs'] > app.config.get('MAINTENANCE_MAX_PACKS', 20) or \
+           before['loose'] > app.config.get('MAINTENANCE_MAX_LOOSE', 1000):
+            try:
+                GitOperations.repack(path)
+                after, repacked = GitOperations.object_counts(path), True
+            except GitException as ge:
+                app.logger.warning('failed to repack %s: %s', path, ge.args[0][0])
+        run = MaintenanceRun(path, repacked, before, after, time.time() - started).save()
+        return run.id
+    finally:
+        db.session.remove()
+
+def maintain_repositories(paths):
+    '''Maintain clones with at most MAINTENANCE_CONCURRENCY at a time, a
+    limit separate from that of the refreshes.'''
+    concurrency = app.config.get('MAINTENANCE_CONCURRENCY', 1)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(maintain_clone, paths))
+
+@scheduler.scheduled_job('interval', hours=6)
+def maintain_all_repositories():
+    paths = sorted(set(repository.get_path() for repository in Repository.query))
+    db.session.remove()
+    return maintain_repositories(paths)
+
 def refresh_all_repositories():
-    for repository in Repository.query.all():
-        repository.refresh()
-        repository.save()
+    global refresh_report # pylint: disable=W0603
+    repositories = db.session.query(Repository.id, Repository.location).all()
+    db.session.remove()
+    refresh_report = refresh_repositories(repositories)
+
+@scheduler.scheduled_job('interval', minutes=5)
+def refresh_due_repositories():
+    '''Refresh only the repositories whose next refresh is due.'''
+    global refresh_report # pylint: disable=W0603
+    now = datetime.now()
+    due = db.or_(Repository.next_refresh == None, Repository.next_refresh <= now)
+    repositories = db.session.query(Repository.id, Repository.location).filter(due).all()
+    db.session.remove()
+    if repositories:
+        refresh_report = refresh_repositories(repositories)
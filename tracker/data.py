@@ -1,28 +1,28 @@
 # pylint: disable=C0103,C0111
 
-from operator import attrgetter
 from sys import maxsize
 
+from .models import db, Repository, DailyActivity
 from .git import GitMixin
 
 class DataOperations(object):
+    '''Activity over a query of repositories, answered from the daily
+    rollups instead of the git history.'''
 
-    def __init__(self, repositories, start=None, end=None):
-        if start:
-            self.first_updated = int(start)
-        else:
-            values = [repository.get_first_updated() for repository in repositories]
-            self.first_updated = min(values, default=maxsize)
+    def __init__(self, repositories, start=None, end=None, resolution='day'):
+        first_commit, last_commit = repositories.with_entities(
+            db.func.min(Repository.first_commit),
+            db.func.max(Repository.last_commit)).one()
+        start = int(start) if start else DataOperations.timestamp(first_commit)
+        end = int(end) if end else DataOperations.timestamp(last_commit)
+        self.first_updated = maxsize if start is None else start
+        self.last_updated = 0 if end is None else end
+        histogram = DailyActivity.histogram(repositories, start, end)
+        self.histogram = GitMixin.rebucket(histogram, resolution)
 
-        if end:
-            self.last_updated = int(end)
-        else:
-            values = [repository.get_last_updated() for repository in repositories]
-            self.last_updated = max(values, default=0)
-
-        # calculate histogram.
-        commits = []
-        for repository in repositories:
-            commits.extend(list(repository.commits_between(self.first_updated, self.last_updated)))
-        commits.sort(key=attrgetter('commit_time'))
-        self.histogram = GitMixin.group_by(commits)
+    @staticmethod
+    def timestamp(when):
+        # first_commit and last_commit are stored as local times.
+        if when is None:
+            return None
+        return int(when.timestamp())
@@ -1,23 +1,42 @@
 # pylint: disable=C0103,C0111,W0141
 
-from itertools import islice, dropwhile, takewhile, groupby
+from itertools import islice, groupby
+from fnmatch import fnmatchcase
+from heapq import nlargest
 from operator import itemgetter
 from calendar import timegm
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
-from pygit2 import Tag, Commit, Repository, Keypair, GitError, \
-    GIT_SORT_TOPOLOGICAL, GIT_SORT_TIME, GIT_SORT_REVERSE, \
-    clone_repository
+from pygit2 import Tag, Commit, Repository, Keypair, GitError, Oid, \
+    GIT_SORT_TOPOLOGICAL, GIT_SORT_TIME, \
+    init_repository
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from struct import pack, unpack, error as StructError
+from collections import OrderedDict, defaultdict
+from threading import Lock
+import hashlib
+import json
 import re
 import os
+import shlex
+import shutil
+import subprocess
 
 from tracker import app
+from .cache import statistics_cache, repository_pool
+from .index import CommitIndex, RefSnapshot, day_of
 
 class GitException(Exception):
     pass
 
 class GitOperations(object):
 
+    # ingestion modes: a full clone, or commits and trees without blobs.
+    FULL = 'full'
+    METADATA = 'metadata'
+    modes = [FULL, METADATA]
+
     @staticmethod
     def git_uri_parse(git_repo):
         '''Parse out git user/repository name from the git uri.'''
@@ -40,6 +59,36 @@ class GitOperations(object):
             git_username = results[0].split('@')[0]
         return git_username, repository_name
 
+    @staticmethod
+    def git_uri_host(git_repo):
+        '''Parse out the (lowercase) host name from the git uri.'''
+        if '://' in git_repo:
+            _, _, stripped = git_repo.partition('://')
+            host = stripped.split('/')[0]
+        elif ':' in git_repo:
+            host = git_repo.split(':')[0]
+        else:
+            # a local path.
+            return ''
+        host = host.rpartition('@')[2]
+        return host.split(':')[0].lower()
+
+    @staticmethod
+    def git_uri_key(git_repo):
+        '''Normalize the git uri so that every spelling of the same remote
+        (protocol, git user, trailing .git) maps onto one key.'''
+        host = GitOperations.git_uri_host(git_repo)
+        if '://' in git_repo:
+            path = git_repo.partition('://')[2].partition('/')[2]
+        elif host:
+            path = git_repo.partition(':')[2]
+        else:
+            path = os.path.abspath(git_repo)
+        path = path.strip('/')
+        if path.endswith('.git'):
+            path = path[:-len('.git')]
+        return host + '/' + path
+
     @staticmethod
     def get_credentials(git_user, user):
         return Keypair(git_user,
@@ -54,37 +103,392 @@ class GitOperations(object):
                             git_name)
 
     @staticmethod
-    def create_repository(user, git_repo):
-        from .models import Repository as LocalRepository
+    def mirror_key(git_repo, mode=FULL):
+        '''Metadata-only clones lack blobs, so they get mirrors of their own.'''
+        key = GitOperations.git_uri_key(git_repo)
+        if mode != GitOperations.FULL:
+            key += '#' + mode
+        return key
+
+    @staticmethod
+    def get_mirror_location(key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(app.config['REPOSITORY_FOLDER'],
+                            'mirrors',
+                            digest + '.git')
+
+    # branch heads only: pull request and other server side references
+    # are not fetched unless a repository asks for them.
+    default_refspecs = ['+refs/heads/*:refs/remotes/origin/*']
+    refspec_regex = re.compile(r'^\+?refs/[^:\s]+:refs/remotes/origin/[^:\s]+$')
+
+    @staticmethod
+    def valid_refspec(refspec):
+        '''Refspecs may only write below refs/remotes/origin/.'''
+        if not GitOperations.refspec_regex.match(refspec):
+            return False
+        source, _, destination = refspec.lstrip('+').partition(':')
+        return source.count('*') == destination.count('*') <= 1
+
+    @staticmethod
+    def fetch_refspecs(refspecs, branch):
+        '''`refspecs` (or the default ones) plus the default branch.'''
+        refspecs = list(refspecs or GitOperations.default_refspecs)
+        source = 'refs/heads/' + branch
+        covered = ['refs/heads/*', source]
+        if not any(refspec.lstrip('+').partition(':')[0] in covered for refspec in refspecs):
+            refspecs.append('+%s:refs/remotes/origin/%s' % (source, branch))
+        return refspecs
+
+    @staticmethod
+    def default_branch(git_repo, creds):
+        '''The branch the remote's HEAD points at, if the remote says.'''
+        try:
+            output = GitOperations.git_command(creds, 'ls-remote', '--symref', git_repo, 'HEAD')
+        except GitException:
+            # the fetch itself reports unreachable remotes.
+            return None
+        for line in output.splitlines():
+            if line.startswith('ref: refs/heads/'):
+                return line[len('ref: refs/heads/'):].split('\t')[0]
+        return None
+
+    @staticmethod
+    def check_access(git_repo, creds):
+        '''Raise a GitException unless `creds` may read `git_repo`. Only the
+        remote's HEAD is listed, so this is much cheaper than a fetch.'''
+        GitOperations.git_command(creds, 'ls-remote', git_repo, 'HEAD')
+
+    @staticmethod
+    def get_head_branch(ondisk):
+        '''The branch HEAD points at (master for new clones).'''
+        return ondisk.lookup_reference('HEAD').target[len('refs/heads/'):]
+
+    @staticmethod
+    def fetch(ondisk, git_repo, creds, progress=None, refspecs=None):
+        '''Fetch `refspecs` of `git_repo` into origin with the given
+        credentials and point HEAD at the remote's default branch. Returns
+        how many objects and bytes were received.'''
+        remote = [remote for remote in ondisk.remotes if remote.name == 'origin'][0]
+        if remote.url != git_repo:
+            # the same mirror may be reached through another spelling.
+            remote.url = git_repo
+        branch = GitOperations.default_branch(git_repo, creds) or \
+                 GitOperations.get_head_branch(ondisk)
+        remote.fetch_refspecs = GitOperations.fetch_refspecs(refspecs, branch)
+        remote.credentials = creds
+        if progress:
+            remote.transfer_progress = progress
+        stats = remote.fetch()
+        GitOperations.update_head(ondisk, branch)
+        return {'received_objects': stats.received_objects,
+                'received_bytes': stats.received_bytes}
+
+    @staticmethod
+    def update_head(ondisk, branch):
+        '''Move `branch` along with its remote counterpart and make it HEAD.'''
+        try:
+            remote_ref = ondisk.lookup_reference('refs/remotes/origin/' + branch)
+        except KeyError:
+            # an empty repository.
+            return
+        ondisk.create_reference('refs/heads/' + branch, remote_ref.target, force=True)
+        ondisk.create_reference('HEAD', 'refs/heads/' + branch, force=True)
+
+    @staticmethod
+    def clone(git_repo, where, creds, progress=None):
+        '''A bare clone of `git_repo` that reports its transfer statistics
+        to `progress` as objects are received. A failed clone leaves
+        nothing behind.'''
+        existed = os.path.exists(where)
+        repository_pool.pop(where)
         try:
-            git_user, git_name = GitOperations.git_uri_parse(git_repo)
-            creds = GitOperations.get_credentials(git_user, user)
-            where = GitOperations.get_repository_location(user, git_name)
-            clone_repository(git_repo, where, bare=True, credentials=creds)
-            repo = LocalRepository(user, git_user, git_name, git_repo).save()
-            return repo
+            ondisk = init_repository(where, bare=True)
+            ondisk.create_remote('origin', git_repo)
+            GitOperations.fetch(ondisk, git_repo, creds, progress)
+            return ondisk
         except GitError as e:
+            if not existed:
+                shutil.rmtree(where, ignore_errors=True)
             raise GitException(e.args)
         except ValueError as e: # pragma: no cover
+            if not existed:
+                shutil.rmtree(where, ignore_errors=True)
             raise GitException(e.args)
 
+    @staticmethod
+    def git_command(creds, *args):
+        '''Run the git command line, authenticating over ssh with the
+        private key of `creds`.'''
+        env = dict(os.environ)
+        private_key = creds.credential_tuple[2] if creds else None
+        if private_key:
+            env['GIT_SSH_COMMAND'] = 'ssh -i %s -o IdentitiesOnly=yes' % shlex.quote(private_key)
+        try:
+            return subprocess.check_output(['git'] + list(args),
+                                           stderr=subprocess.STDOUT,
+                                           env=env).decode('utf-8', 'replace')
+        except subprocess.CalledProcessError as e:
+            lines = e.output.decode('utf-8', 'replace').strip().splitlines()
+            errors = [line for line in lines if line.startswith(('fatal:', 'error:'))]
+            raise GitException(((errors or lines or [str(e)])[0],))
+        except OSError as e: # pragma: no cover
+            raise GitException((str(e),))
+
+    @staticmethod
+    def count_objects(git):
+        '''Objects and bytes stored by a clone, loose and packed.'''
+        counts = dict(line.split(': ') for line in git('count-objects', '-v').splitlines())
+        objects = int(counts['count']) + int(counts['in-pack'])
+        return objects, 1024 * (int(counts['size']) + int(counts['size-pack']))
+
+    @staticmethod
+    def fetch_metadata(git_repo, where, creds, refspecs=None):
+        '''Fetch the commits and trees of `git_repo`, but no blobs, into a
+        bare clone at `where` (created if need be). libgit2 cannot filter
+        fetches, so this goes through the git command line. Returns how
+        much the clone grew.'''
+        existed = os.path.exists(where)
+        git = lambda *args: GitOperations.git_command(creds, '-C', where, *args)
+        try:
+            if not existed:
+                repository_pool.pop(where)
+                GitOperations.git_command(creds, 'init', '--quiet', '--bare', where)
+                git('remote', 'add', 'origin', git_repo)
+            git('remote', 'set-url', 'origin', git_repo)
+            objects, size = GitOperations.count_objects(git)
+            branch = GitOperations.default_branch(git_repo, creds) or \
+                     git('symbolic-ref', 'HEAD').strip()[len('refs/heads/'):]
+            args = ['fetch', '--quiet', '--filter=blob:none']
+            if not GitOperations.git_uri_host(git_repo):
+                # local remotes only serve filtered fetches when asked to.
+                args.append('--upload-pack=git -c uploadpack.allowfilter=true upload-pack')
+            git(*(args + ['origin'] + GitOperations.fetch_refspecs(refspecs, branch)))
+            # partial clones are marked with a repository format libgit2
+            # refuses to open; the missing blobs are never looked up.
+            git('config', 'core.repositoryformatversion', '0')
+            after_objects, after_size = GitOperations.count_objects(git)
+            transfer = {'received_objects': after_objects - objects,
+                        'received_bytes': max(after_size - size, 0)}
+            remote_ref = 'refs/remotes/origin/' + branch
+            try:
+                git('rev-parse', '--verify', '--quiet', remote_ref)
+            except GitException:
+                # an empty repository.
+                return transfer
+            git('update-ref', 'refs/heads/' + branch, remote_ref)
+            git('symbolic-ref', 'HEAD', 'refs/heads/' + branch)
+            return transfer
+        except GitException:
+            if not existed:
+                shutil.rmtree(where, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def object_counts(where):
+        '''Packs, loose objects and bytes in the object store of a clone.'''
+        objects = os.path.join(where, 'objects')
+        counts = {'packs': 0, 'loose': 0, 'size': 0}
+        for name in os.listdir(objects):
+            directory = os.path.join(objects, name)
+            if name == 'pack':
+                for entry in os.listdir(directory):
+                    if entry.endswith('.pack'):
+                        counts['packs'] += 1
+                    counts['size'] += os.path.getsize(os.path.join(directory, entry))
+            elif len(name) == 2:
+                for entry in os.listdir(directory):
+                    counts['loose'] += 1
+                    counts['size'] += os.path.getsize(os.path.join(directory, entry))
+        return counts
+
+    @staticmethod
+    def repack(where):
+        '''Pack every object of a clone into a single pack and drop the
+        redundant packs and loose objects.'''
+        with GitOperations.clone_lock(where):
+            GitOperations.git_command(None, '-C', where, 'repack', '-a', '-d', '-q')
+            GitOperations.git_command(None, '-C', where, 'prune', '--expire=2.weeks.ago')
+            # pooled handles still map the removed packs.
+            repository_pool.pop(where)
+
+    # one lock per clone, so that concurrent jobs adding the same remote
+    # clone it once and maintenance never runs during a fetch.
+    clone_locks = defaultdict(Lock)
+    clone_locks_lock = Lock()
+
+    @staticmethod
+    def clone_lock(where):
+        with GitOperations.clone_locks_lock:
+            return GitOperations.clone_locks[where]
+
+    @staticmethod
+    def mirror_lock(git_repo, mode=FULL):
+        key = GitOperations.mirror_key(git_repo, mode)
+        return GitOperations.clone_lock(GitOperations.get_mirror_location(key))
+
+    @staticmethod
+    def mirror(git_repo, creds, progress=None, mode=FULL, refspecs=None):
+        '''Bring the shared mirror of `git_repo` up to date with the given
+        credentials, cloning it if this is the first user of the remote.
+        The fetch always runs, so that a user only gains access to an
+        existing mirror when their own credentials are accepted. Returns
+        the transfer statistics of the fetch, if there was one.'''
+        with GitOperations.mirror_lock(git_repo, mode):
+            return GitOperations.update_mirror(git_repo, creds, progress, mode, refspecs)
+
+    @staticmethod
+    def update_mirror(git_repo, creds, progress=None, mode=FULL, refspecs=None):
+        '''mirror(), for callers that already hold the mirror's lock.'''
+        where = GitOperations.get_mirror_location(GitOperations.mirror_key(git_repo, mode))
+        if mode == GitOperations.METADATA:
+            return GitOperations.fetch_metadata(git_repo, where, creds, refspecs)
+        if not os.path.exists(where):
+            GitOperations.clone(git_repo, where, creds, progress)
+            return None
+        ondisk = repository_pool.get(where)
+        if ondisk is None:
+            ondisk = repository_pool.put(where, Repository(where))
+        try:
+            return GitOperations.fetch(ondisk, git_repo, creds, progress, refspecs)
+        except GitError as e:
+            raise GitException(e.args)
+
+    @staticmethod
+    def create_repository(user, git_repo, progress=None, mode=FULL):
+        from .models import Repository as LocalRepository, Mirror
+        git_user, git_name = GitOperations.git_uri_parse(git_repo)
+        creds = GitOperations.get_credentials(git_user, user)
+        # a single hold of the lock: the mirror cannot be removed between
+        # the fetch and taking a reference on it.
+        with GitOperations.mirror_lock(git_repo, mode):
+            # checked again here: another job may have added it meanwhile.
+            if user.repositories.filter_by(name=git_name).first():
+                raise GitException(('Given repository already exists.',))
+            GitOperations.update_mirror(git_repo, creds, progress, mode)
+            repository = LocalRepository(user, git_user, git_name, git_repo, mode)
+            repository.mirror = Mirror.acquire(git_repo, mode)
+            return repository.save()
+
 class GitMixin(object):
 
     tag_or_remote_regex = re.compile('^refs/(tags|remotes)/(.*)')
+    resolutions = ['day', 'week', 'month', 'year']
+
+    def get_path(self):
+        '''Where the bare clone lives: the shared mirror of the remote, or a
+        clone of its own for repositories added before mirrors existed.'''
+        if self.mirror is not None:
+            return self.mirror.get_path()
+        return GitOperations.get_repository_location(self.user, self.name)
 
-    def __init__(self):
-        where = GitOperations.get_repository_location(self.user, self.name)
-        self.ondisk = Repository(where)
+    @property
+    def ondisk(self):
+        '''The on-disk repository, opened on first use and pooled by path.'''
+        where = self.get_path()
+        ondisk = repository_pool.get(where)
+        if ondisk is None:
+            ondisk = repository_pool.put(where, Repository(where))
+        return ondisk
+
+    def release(self):
+        repository_pool.pop(self.get_path())
+        CommitIndex.close(self.get_path())
 
     def refresh(self):
+        '''Fetch the clone's refspecs; returns the transfer statistics.'''
+        creds = GitOperations.get_credentials(self.git_user, self.user)
+        refspecs = self.get_fetch_refspecs()
+        if self.mirror is not None:
+            transfer = GitOperations.mirror(self.location, creds, mode=self.mode,
+                                            refspecs=refspecs)
+        else:
+            try:
+                with GitOperations.clone_lock(self.get_path()):
+                    transfer = GitOperations.fetch(self.ondisk, self.location, creds,
+                                                   refspecs=refspecs)
+            except GitError as e:
+                raise GitException(e.args)
+        self.get_ref_snapshot()
+        return transfer
+
+    def check_access(self):
+        '''Check the user's credentials against the remote without fetching.'''
         creds = GitOperations.get_credentials(self.git_user, self.user)
-        for remote in self.ondisk.remotes:
-            remote.credentials = creds
-            remote.fetch()
-        # update current reference
-        master_ref = self.ondisk.lookup_reference('refs/heads/master')
-        remote_ref = self.ondisk.lookup_reference('refs/remotes/origin/master')
-        master_ref.set_target(remote_ref.target)
+        GitOperations.check_access(self.location, creds)
+
+    def get_default_branch(self):
+        return GitOperations.get_head_branch(self.ondisk)
+
+    def get_tracked_refs(self):
+        '''References whose history is indexed: the default branch and the
+        fetched branches that match one of the repository's patterns.'''
+        default = self.get_default_branch()
+        refs = ['refs/heads/' + default]
+        patterns = self.get_branches()
+        if not patterns:
+            return refs
+        prefix = 'refs/remotes/origin/'
+        for name in self.ondisk.listall_references():
+            if not name.startswith(prefix):
+                continue
+            branch = name[len(prefix):]
+            if branch not in ['HEAD', default] and \
+               any(fnmatchcase(branch, pattern) for pattern in patterns):
+                refs.append(name)
+        return refs
+
+    def get_tips(self):
+        '''Map each tracked reference to the (hex) oid it points at.'''
+        tips = {}
+        for name in self.get_tracked_refs():
+            try:
+                ref = self.ondisk.lookup_reference(name)
+            except KeyError:
+                continue
+            tips[name] = str(ref.target)
+        return tips
+
+    def is_ancestor(self, old, new):
+        base = self.ondisk.merge_base(Oid(hex=old), Oid(hex=new))
+        return base is not None and str(base) == old
+
+    def walk_tips(self, tips, flags=GIT_SORT_TIME):
+        '''One walk over the union of the histories of `tips`: a commit
+        reachable from several tips is visited once.'''
+        oids = list(tips.values())
+        walker = self.ondisk.walk(Oid(hex=oids[0]), flags)
+        for oid in oids[1:]:
+            walker.push(Oid(hex=oid))
+        return walker
+
+    def walk_since(self, indexed, tips, flags=GIT_SORT_TIME):
+        '''Walk the commits reachable from `tips` that were not reachable
+        from the previously `indexed` tips. Returns the walker and whether
+        the walk is incremental; if a tracked reference was rewritten
+        (e.g. a force push) or is no longer tracked the whole history is
+        walked again.'''
+        incremental = all(name in tips and self.is_ancestor(oid, tips[name])
+                          for name, oid in indexed.items())
+        walker = self.walk_tips(tips, flags)
+        if incremental:
+            for oid in indexed.values():
+                walker.hide(Oid(hex=oid))
+        return walker, incremental
+
+    def get_index_name(self):
+        '''Repositories that track other branches of a shared clone need
+        an index of their own.'''
+        patterns = self.get_branches()
+        if not patterns:
+            return None
+        return hashlib.sha1(json.dumps(sorted(patterns)).encode('utf-8')).hexdigest()[:12]
+
+    def get_index(self):
+        '''The time index of the tracked history, updated if stale.'''
+        index = CommitIndex.open(self.ondisk.path, self.get_index_name())
+        index.update(self, self.get_tips())
+        return index
 
     def filter_references(self, regex):
         return [ref for ref in self.ondisk.listall_references()
@@ -98,22 +502,37 @@ class GitMixin(object):
             return ref.commit_time
         raise GitException('invalid reference: commit time could not be found.') # pragma: no cover
 
+    def resolve_ref(self, name, previous=None):
+        target = str(self.ondisk.lookup_reference(name).target)
+        if previous and previous[0] == target:
+            return previous
+        return [target, self.get_commit_time(name)]
+
+    def get_ref_snapshot(self):
+        snapshot = RefSnapshot.open(self.ondisk.path)
+        names = lambda: self.filter_references(GitMixin.tag_or_remote_regex)
+        snapshot.update(names, self.resolve_ref)
+        return snapshot
+
     def get_latest_refs(self, count=None):
-        info = self.filter_references(GitMixin.tag_or_remote_regex)
-        refs = list(zip(info, map(self.get_commit_time, info)))
-        refs.sort(key=itemgetter(1), reverse=True)
+        refs = self.get_ref_snapshot().items()
+        if count:
+            refs = nlargest(count, refs, key=itemgetter(1))
+        else:
+            refs.sort(key=itemgetter(1), reverse=True)
         def ref_info(info):
             (ref, commit_time) = info
             what, name = GitMixin.tag_or_remote_regex.findall(ref)[0]
             return (what, name, commit_time)
-        refs = map(ref_info, refs)
-        if not count:
-            return refs
-        return islice(refs, count)
+        return map(ref_info, refs)
+
+    def get_emails(self):
+        return [ue.email for ue in self.user.emails.all()]
 
     def filter_commits(self, flags=0):
-        all_commits = self.ondisk.walk(self.ondisk.head.target, flags)
-        emails = [ue.email for ue in self.user.emails.all()]
+        tips = self.get_tips()
+        all_commits = self.walk_tips(tips, flags) if tips else []
+        emails = self.get_emails()
         return filter(lambda commit: commit.author.email in emails, all_commits)
 
     def get_commits(self, count=None):
@@ -122,8 +541,39 @@ class GitMixin(object):
             return all_commits
         return islice(all_commits, count)
 
+    @staticmethod
+    def encode_cursor(commit_time, oid):
+        return urlsafe_b64encode(pack('>q20s', commit_time, oid)).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            return unpack('>q20s', urlsafe_b64decode(cursor.encode('ascii')))
+        except (StructError, BinasciiError, UnicodeEncodeError):
+            raise ValueError('invalid cursor')
+
+    def get_commit_page(self, count=None, cursor=None):
+        '''The newest matching commits (by commit time) older than the one
+        identified by `cursor`, and the cursor of the following page. The
+        cost of a page does not depend on how deep it is.'''
+        index = self.get_index()
+        before = None
+        if cursor:
+            commit_time, oid = GitMixin.decode_cursor(cursor)
+            before = index.position(commit_time, oid)
+            if before is None:
+                # the commit is gone (rewritten history): resume by time.
+                before = index.span(commit_time, commit_time)[0]
+        positions = index.latest(self.get_emails(), count, before)
+        commits = (self.ondisk[Oid(raw=index.oid_at(i))] for i in positions)
+        next_cursor = None
+        if count and len(positions) == count:
+            last = positions[-1]
+            next_cursor = GitMixin.encode_cursor(int(index.times[last]), index.oid_at(last))
+        return commits, next_cursor
+
     def get_commit_count(self):
-        return len(list(self.filter_commits()))
+        return self.get_index().count(self.get_emails())[0]
 
     def get_shorthand_of_branch(self, branch):
         commit = self.ondisk.lookup_branch(branch)
@@ -137,64 +587,235 @@ class GitMixin(object):
             return str(commit.get_object().id)[:6]
         return '(none)'
 
-    def get_numstat(self, commit):
-        diff = None
+    def has_blobs(self):
+        return self.mode != GitOperations.METADATA
+
+    def get_diff(self, commit):
+        '''The changes of `commit` against its first parent.'''
         try:
             previous_commit = self.ondisk.revparse_single(str(commit.id) + '^')
-            diff = self.ondisk.diff(previous_commit, commit)
+            return self.ondisk.diff(previous_commit, commit)
         except KeyError:
             # likely we hit the very first commit.
-            diff = commit.tree.diff_to_tree(swap=True)
+            return commit.tree.diff_to_tree(swap=True)
+
+    def get_numstat(self, commit):
+        if not self.has_blobs():
+            # unknown without the blobs of a metadata-only clone.
+            return (None, None, None)
+        diff = self.get_diff(commit)
         additions, deletions = 0, 0
         for patch in diff:
             additions += patch.additions
             deletions += patch.deletions
         return (len(diff), additions, deletions)
 
+    def get_path_stats(self, commit):
+        '''(path, additions, deletions) of every file `commit` changed.'''
+        return GitMixin.path_stats(self.get_diff(commit))
+
+    @staticmethod
+    def path_stats(diff):
+        '''(path, additions, deletions) of every file in `diff`. A type
+        change (e.g. a file replaced by a symlink) comes as a deletion and
+        an addition of the same path, which are summed.'''
+        totals = OrderedDict()
+        for patch in diff:
+            total = totals.setdefault(patch.new_file_path, [0, 0])
+            total[0] += patch.additions
+            total[1] += patch.deletions
+        return [(path, additions, deletions) for path, (additions, deletions) in totals.items()]
+
+    @staticmethod
+    def churn(path_stats, depth=1, prefix=''):
+        '''Sum additions, deletions and the number of commits touching each
+        directory below `prefix`, cut `depth` levels below it, from the
+        path stats of a series of commits. Files right below `prefix`
+        count towards `prefix` itself.'''
+        base = prefix.strip('/')
+        totals = {}
+        for stats in path_stats:
+            touched = set()
+            for path, additions, deletions in stats:
+                if base:
+                    if not path.startswith(base + '/'):
+                        continue
+                    path = path[len(base) + 1:]
+                directories = path.split('/')[:-1][:depth]
+                directory = '/'.join([base] + directories if base else directories)
+                total = totals.setdefault(directory, [0, 0, 0])
+                total[0] += additions
+                total[1] += deletions
+                touched.add(directory)
+            for directory in touched:
+                totals[directory][2] += 1
+        churn = [{'directory': directory, 'additions': additions,
+                  'deletions': deletions, 'commits': commits}
+                 for directory, (additions, deletions, commits) in totals.items()]
+        churn.sort(key=lambda entry: (-(entry['additions'] + entry['deletions']),
+                                      entry['directory']))
+        return churn
+
     def get_first_updated(self):
-        all_commits = self.ondisk.walk(self.ondisk.head.target,
-                                       GIT_SORT_TIME | GIT_SORT_REVERSE)
-        first_commit = next(all_commits)
-        return first_commit.commit_time
+        return self.get_index().first()
 
     def get_last_updated(self):
-        all_commits = self.ondisk.walk(self.ondisk.head.target,
-                                       GIT_SORT_TIME)
-        last_commit = next(all_commits)
-        return last_commit.commit_time
+        return self.get_index().last()
+
+    @staticmethod
+    def count_tree(tree):
+        '''Count the files and lines of a tree in a single diff.'''
+        diff = tree.diff_to_tree()
+        file_count, line_count = 0, 0
+        for patch in diff:
+            file_count += 1
+            line_count += patch.deletions
+        return (file_count, line_count)
+
+    @staticmethod
+    def count_tree_change(old_tree, new_tree, counts):
+        '''Derive the counts of `new_tree` from the `counts` of `old_tree`
+        by looking only at what changed between them.'''
+        file_count, line_count = counts
+        for patch in old_tree.diff_to_tree(new_tree):
+            if patch.status == 'A':
+                file_count += 1
+            elif patch.status == 'D':
+                file_count -= 1
+            line_count += patch.additions - patch.deletions
+        return (file_count, line_count)
+
+    def get_tree_stats(self):
+        return GitMixin.count_tree(self.ondisk.head.get_object().tree)
 
     def get_file_count(self):
-        diff = self.ondisk.head.get_object().tree.diff_to_tree()
-        return len([patch.old_file_path for patch in diff])
+        return self.get_tree_stats()[0]
 
     def get_line_count(self):
-        diff = self.ondisk.head.get_object().tree.diff_to_tree()
-        return sum([patch.deletions for patch in diff])
+        return self.get_tree_stats()[1]
 
     def get_author_count(self):
-        commits = self.filter_commits()
-        return len(set([commit.author.email for commit in commits]))
+        return self.get_index().count(self.get_emails())[1]
 
     def commits_between(self, start, end):
-        all_commits = self.filter_commits(GIT_SORT_TIME | GIT_SORT_REVERSE)
-        starting = dropwhile(lambda obj: obj.commit_time < start, all_commits)
-        return takewhile(lambda obj: obj.commit_time <= end, starting)
+        index = self.get_index()
+        for _, oid in index.between(start, end, self.get_emails()):
+            yield self.ondisk[Oid(raw=oid)]
+
+    @staticmethod
+    def day_of(commit_time):
+        return day_of(commit_time)
 
     @staticmethod
     def by_day(obj):
-        # we want to group our commit times by the day. so convert
-        # timestamp -> date -> timestamp
-        new_date = date.fromtimestamp(obj.commit_time)
-        new_date += timedelta(days=1)
-        return timegm(new_date.timetuple())
+        return GitMixin.day_of(obj.commit_time)
 
     @staticmethod
-    def group_by(series):
-        result = groupby(series, GitMixin.by_day)
+    def group_times(times):
+        '''Histogram of an ordered series of commit times.'''
+        result = groupby(times, GitMixin.day_of)
         return [{'date': commit_date,
-                 'value': len(list(commits))}
-                for commit_date, commits in result]
+                 'value': sum(1 for _ in group)}
+                for commit_date, group in result]
+
+    @staticmethod
+    def bucket_of(day, resolution):
+        '''Map a day (see day_of) to the first day of its bucket. Days are
+        keyed by the following midnight, so the day is shifted back before
+        bucketing and the bucket start is shifted forward again.'''
+        when = datetime.utcfromtimestamp(day).date() - timedelta(days=1)
+        if resolution == 'week':
+            when -= timedelta(days=when.weekday())
+        elif resolution == 'month':
+            when = when.replace(day=1)
+        elif resolution == 'year':
+            when = when.replace(month=1, day=1)
+        return timegm((when + timedelta(days=1)).timetuple())
+
+    @staticmethod
+    def rebucket(histogram, resolution='day'):
+        '''Sum an ordered daily histogram into coarser buckets.'''
+        if resolution == 'day':
+            return histogram
+        result = groupby(histogram, lambda entry: GitMixin.bucket_of(entry['date'], resolution))
+        return [{'date': bucket,
+                 'value': sum(entry['value'] for entry in entries)}
+                for bucket, entries in result]
+
+    @staticmethod
+    def next_bucket(bucket, resolution):
+        '''The bucket after `bucket`, in the day_of convention.'''
+        when = datetime.utcfromtimestamp(bucket).date() - timedelta(days=1)
+        if resolution == 'week':
+            when += timedelta(days=7)
+        elif resolution == 'month':
+            when = date(when.year + when.month // 12, when.month % 12 + 1, 1)
+        elif resolution == 'year':
+            when = date(when.year + 1, 1, 1)
+        else:
+            when += timedelta(days=1)
+        return timegm((when + timedelta(days=1)).timetuple())
+
+    @staticmethod
+    def compact(histogram, resolution='day'):
+        '''Encode a histogram as its first bucket followed by run-length
+        encoded [value, run] pairs over every bucket up to the last one,
+        empty buckets included.'''
+        runs = []
+        bucket = histogram[0]['date'] if histogram else None
+        for entry in histogram:
+            while bucket < entry['date']:
+                GitMixin.append_run(runs, 0)
+                bucket = GitMixin.next_bucket(bucket, resolution)
+            GitMixin.append_run(runs, entry['value'])
+            bucket = GitMixin.next_bucket(bucket, resolution)
+        widths = {'day': 86400, 'week': 7 * 86400}
+        return {'start': histogram[0]['date'] if histogram else None,
+                'resolution': resolution,
+                'width': widths.get(resolution), # months and years vary.
+                'values': runs}
+
+    @staticmethod
+    def append_run(runs, value):
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+
+    @staticmethod
+    def group_by(series):
+        return GitMixin.group_times(obj.commit_time for obj in series)
+
+    def day_counts(self, start, end):
+        return self.get_index().day_counts(start, end, self.get_emails())
 
     def histogram(self, start, end):
-        series = self.commits_between(start, end)
-        return GitMixin.group_by(series)
+        return [{'date': day, 'value': count}
+                for day, count in self.day_counts(start, end)]
+
+    def collect_statistics(self, start=None, end=None):
+        '''Gather everything the repository view needs from the time
+        index: first and last commit times, the histogram of matching
+        commits between `start` and `end` and the number of matching
+        commits and authors.'''
+        index = self.get_index()
+        commit_count, author_count = index.count(self.get_emails())
+        file_count, line_count = self.get_tree_stats()
+        return {'first_updated': index.first(),
+                'last_updated': index.last(),
+                'histogram': self.histogram(start, end),
+                'commit_count': commit_count,
+                'author_count': author_count,
+                'file_count': file_count,
+                'line_count': line_count}
+
+    def get_statistics(self, start=None, end=None):
+        '''Statistics are a function of the tracked tips, the user's emails
+        and the query, so identical requests share one walk.'''
+        key = (self.ondisk.path, tuple(sorted(self.get_tips().items())),
+               tuple(sorted(self.get_emails())), start, end)
+        statistics = statistics_cache.get(key)
+        if statistics is None:
+            statistics = self.collect_statistics(start, end)
+            statistics_cache.put(key, statistics)
+        return statistics
@@ -0,0 +1,383 @@
+# pylint: disable=C0103,C0111
+
+from array import array
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from collections import Counter
+from datetime import date, timedelta
+from heapq import merge
+from threading import Lock
+import hashlib
+import json
+import time
+import os
+
+from .cache import index_pool
+
+try:
+    import numpy
+    # isin replaced in1d, which later releases removed.
+    isin = getattr(numpy, 'isin', None) or numpy.in1d
+except ImportError: # pragma: no cover
+    numpy = None
+
+def day_of(commit_time):
+    # we want to group our commit times by the day. so convert
+    # timestamp -> date -> timestamp
+    new_date = date.fromtimestamp(commit_time)
+    new_date += timedelta(days=1)
+    return timegm(new_date.timetuple())
+
+class CommitIndex(object):
+    '''Commits of a repository sorted by commit time.
+
+    The index is a columnar store in a `tracker` folder inside the bare
+    clone: fixed-width arrays of commit times, interned author ids, raw
+    oids and numstats (-1 while unknown), plus the interned emails and the
+    tips it was built from. With NumPy installed the columns are
+    memory-mapped and scanned with vectorized operations; otherwise they
+    are read into `array`s.'''
+
+    OID_SIZE = 20
+    NUMSTAT_SIZE = 3
+    UNKNOWN = -1
+
+    # name -> (array typecode, numpy dtype)
+    columns = {'times': ('q', 'int64'),
+               'authors': ('i', 'int32'),
+               'numstat': ('i', 'int32')}
+
+    indexes_lock = Lock()
+
+    def __init__(self, path, name=None):
+        self.path = os.path.join(path, 'tracker')
+        if name:
+            # indexes of other sets of tracked references.
+            self.path = os.path.join(self.path, 'index-' + name)
+        self.lock = Lock()
+        self.clear()
+        self.load()
+
+    @staticmethod
+    def open(path, name=None):
+        '''Share one in-memory index per clone (and set of tracked
+        references) across requests. Only the indexes of recently used
+        clones are kept open.'''
+        path = os.path.abspath(path)
+        with CommitIndex.indexes_lock:
+            indexes = index_pool.get(path)
+            if indexes is None:
+                indexes = index_pool.put(path, {})
+            if name not in indexes:
+                indexes[name] = CommitIndex(path, name)
+            return indexes[name]
+
+    @staticmethod
+    def close(path):
+        '''Drop the open indexes of a clone.'''
+        index_pool.pop(os.path.abspath(path))
+
+    def clear(self):
+        self.times = array('q')
+        self.authors = array('i')
+        self.numstat = array('i')
+        self.oids = bytearray()
+        self.emails = []
+        self.email_ids = {}
+        self.refs = {}
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def read_column(self, name):
+        typecode, dtype = CommitIndex.columns[name]
+        filename = self.filename(name)
+        if numpy is not None:
+            if not os.path.getsize(filename):
+                return numpy.zeros(0, dtype=dtype)
+            return numpy.memmap(filename, dtype=dtype, mode='r')
+        column = array(typecode)
+        with open(filename, 'rb') as f:
+            column.frombytes(f.read())
+        return column
+
+    def read_oids(self):
+        filename = self.filename('oids')
+        if numpy is not None and os.path.getsize(filename):
+            return numpy.memmap(filename, dtype='uint8', mode='r')
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def load(self):
+        try:
+            with open(self.filename('refs.json')) as f:
+                refs = json.load(f)
+            with open(self.filename('emails'), encoding='utf-8') as f:
+                emails = f.read().split('\n')[:-1]
+            times = self.read_column('times')
+            authors = self.read_column('authors')
+            numstat = self.read_column('numstat')
+            oids = self.read_oids()
+        except (OSError, ValueError):
+            return
+        size = len(times)
+        if not size == len(authors) == len(numstat) // CommitIndex.NUMSTAT_SIZE \
+           == len(oids) // CommitIndex.OID_SIZE:
+            return # pragma: no cover
+        self.times, self.authors, self.numstat, self.oids = times, authors, numstat, oids
+        self.emails = emails
+        self.email_ids = {email: i for i, email in enumerate(emails)}
+        self.refs = refs
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        contents = {'times': self.times.tobytes(),
+                    'authors': self.authors.tobytes(),
+                    'numstat': self.numstat.tobytes(),
+                    'oids': bytes(self.oids),
+                    'emails': ''.join(email + '\n' for email in self.emails).encode('utf-8'),
+                    # written last: the tips mark the index as complete.
+                    'refs.json': json.dumps(self.refs).encode('utf-8')}
+        for name in ['times', 'authors', 'numstat', 'oids', 'emails', 'refs.json']:
+            temporary = self.filename(name + '.tmp')
+            with open(temporary, 'wb') as f:
+                f.write(contents[name])
+            os.replace(temporary, self.filename(name))
+
+    def __len__(self):
+        return len(self.times)
+
+    def intern(self, email):
+        if email not in self.email_ids:
+            self.email_ids[email] = len(self.emails)
+            self.emails.append(email)
+        return self.email_ids[email]
+
+    def oid_at(self, i):
+        return bytes(self.oids[i * CommitIndex.OID_SIZE:(i + 1) * CommitIndex.OID_SIZE])
+
+    def numstat_at(self, i):
+        return tuple(int(value) for value in
+                     self.numstat[i * CommitIndex.NUMSTAT_SIZE:(i + 1) * CommitIndex.NUMSTAT_SIZE])
+
+    def entries(self):
+        for i in range(len(self)):
+            yield (int(self.times[i]), self.oid_at(i), int(self.authors[i]), self.numstat_at(i))
+
+    def add(self, commits):
+        '''Insert commits, keeping the columns sorted by commit time.'''
+        unknown = (CommitIndex.UNKNOWN,) * CommitIndex.NUMSTAT_SIZE
+        added = sorted((commit.commit_time, commit.id.raw,
+                        self.intern(commit.author.email), unknown)
+                       for commit in commits)
+        if not added:
+            return
+        times, authors, numstat = array('q'), array('i'), array('i')
+        if len(self) and added[0][0] < self.times[-1]:
+            # rare: an older commit was merged in. rebuild the columns.
+            entries = list(merge(self.entries(), added))
+            oids = bytearray()
+        else:
+            times.frombytes(self.times.tobytes())
+            authors.frombytes(self.authors.tobytes())
+            numstat.frombytes(self.numstat.tobytes())
+            oids = bytearray(self.oids)
+            entries = added
+        for commit_time, oid, author, stats in entries:
+            times.append(commit_time)
+            oids.extend(oid)
+            authors.append(author)
+            numstat.extend(stats)
+        self.times, self.authors, self.numstat, self.oids = times, authors, numstat, oids
+
+    def update(self, repository, tips):
+        '''Bring the index up to date with `tips`, walking only the new
+        commits unless a tracked reference was rewritten.'''
+        with self.lock:
+            if self.refs == tips:
+                return
+            self.load() # another process may have updated it already.
+            if self.refs == tips:
+                return
+            if tips:
+                walker, incremental = repository.walk_since(self.refs, tips)
+                if not incremental:
+                    self.clear()
+                self.add(walker)
+            else:
+                self.clear()
+            self.refs = tips
+            self.save()
+            self.load()
+
+    def position(self, commit_time, oid):
+        lo, hi = self.span(commit_time, commit_time)
+        for i in range(lo, hi):
+            if self.oid_at(i) == oid:
+                return i
+        return None
+
+    def get_numstat(self, commit_time, oid):
+        i = self.position(commit_time, oid)
+        if i is None:
+            return None
+        stats = self.numstat_at(i)
+        return None if stats[0] == CommitIndex.UNKNOWN else stats
+
+    def set_numstat(self, commit_time, oid, stats):
+        '''Write a numstat through to the (possibly mapped) column.'''
+        i = self.position(commit_time, oid)
+        if i is None:
+            return
+        values = array('i', stats)
+        with self.lock, open(self.filename('numstat'), 'r+b') as f:
+            f.seek(i * CommitIndex.NUMSTAT_SIZE * values.itemsize)
+            f.write(values.tobytes())
+        if isinstance(self.numstat, array):
+            self.numstat[i * CommitIndex.NUMSTAT_SIZE:(i + 1) * CommitIndex.NUMSTAT_SIZE] = values
+
+    def first(self):
+        return int(self.times[0]) if len(self) else None
+
+    def last(self):
+        return int(self.times[-1]) if len(self) else None
+
+    def span(self, start=None, end=None):
+        '''Positions of the commits with start <= commit time <= end.'''
+        if numpy is not None:
+            lo = 0 if start is None else int(numpy.searchsorted(self.times, start, 'left'))
+            hi = len(self) if end is None else int(numpy.searchsorted(self.times, end, 'right'))
+        else:
+            lo = 0 if start is None else bisect_left(self.times, start)
+            hi = len(self) if end is None else bisect_right(self.times, end)
+        return lo, max(lo, hi)
+
+    def author_ids(self, emails):
+        return set(self.email_ids[email] for email in emails
+                   if email in self.email_ids)
+
+    def matching(self, lo, hi, emails):
+        '''Positions in [lo, hi) of commits by one of `emails`.'''
+        if numpy is not None:
+            positions = numpy.arange(lo, hi)
+            if emails is None:
+                return positions
+            authors = numpy.fromiter(self.author_ids(emails), dtype='int32')
+            return positions[isin(self.authors[lo:hi], authors)]
+        if emails is None:
+            return range(lo, hi)
+        authors = self.author_ids(emails)
+        return [i for i in range(lo, hi) if self.authors[i] in authors]
+
+    def latest(self, emails, count=None, before=None):
+        '''Positions of the newest matching commits, newest first, that
+        come before position `before`. Only the scanned tail is read.'''
+        hi = len(self) if before is None else before
+        result = []
+        chunk = 256
+        while hi > 0 and (not count or len(result) < count):
+            lo = max(0, hi - chunk)
+            result.extend(reversed([int(i) for i in self.matching(lo, hi, emails)]))
+            hi = lo
+            chunk *= 2
+        return result[:count] if count else result
+
+    def between(self, start=None, end=None, emails=None):
+        '''Yield (commit time, raw oid) in time order for the commits in
+        the given range, optionally restricted to the given authors.'''
+        lo, hi = self.span(start, end)
+        for i in self.matching(lo, hi, emails):
+            yield int(self.times[i]), self.oid_at(i)
+
+    def count(self, emails):
+        '''Number of commits and of distinct authors among `emails`.'''
+        if numpy is not None:
+            authors = self.authors[self.matching(0, len(self), emails)]
+            return len(authors), len(numpy.unique(authors))
+        authors = [self.authors[i] for i in self.matching(0, len(self), emails)]
+        return len(authors), len(set(authors))
+
+    def day_counts(self, start=None, end=None, emails=None):
+        '''Ordered (day, count) pairs of the matching commits, with days
+        as produced by day_of.'''
+        lo, hi = self.span(start, end)
+        positions = self.matching(lo, hi, emails)
+        if not len(positions):
+            return []
+        if numpy is None:
+            return list(Counter(day_of(self.times[i]) for i in positions).items())
+        times = self.times[positions]
+        # local midnights of every day in range: a commit falls on the day
+        # of the last midnight before it. this is exact across DST changes.
+        first = date.fromtimestamp(int(times[0]))
+        days = (date.fromtimestamp(int(times[-1])) - first).days + 1
+        dates = [first + timedelta(days=i) for i in range(days)]
+        midnights = numpy.array([time.mktime(when.timetuple()) for when in dates])
+        counts = numpy.bincount(numpy.searchsorted(midnights, times, 'right') - 1,
+                                minlength=days)
+        return [(timegm((dates[i] + timedelta(days=1)).timetuple()), int(counts[i]))
+                for i in numpy.flatnonzero(counts)]
+
+class RefSnapshot(object):
+    '''Commit times of the tags and remote references of a clone.
+
+    The snapshot is keyed by a fingerprint of the reference database
+    (packed-refs and loose references) and is rebuilt only when that
+    changes; even then only references whose target moved are peeled.'''
+
+    snapshots = {}
+    snapshots_lock = Lock()
+
+    def __init__(self, path):
+        self.root = path
+        self.path = os.path.join(path, 'tracker', 'refs-snapshot.json')
+        self.lock = Lock()
+        self.fingerprint = None
+        self.refs = {} # name -> [target, commit time]
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.fingerprint, self.refs = saved['fingerprint'], saved['refs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def open(path):
+        with RefSnapshot.snapshots_lock:
+            if path not in RefSnapshot.snapshots:
+                RefSnapshot.snapshots[path] = RefSnapshot(path)
+            return RefSnapshot.snapshots[path]
+
+    def current_fingerprint(self):
+        entries = []
+        packed = os.path.join(self.root, 'packed-refs')
+        if os.path.exists(packed):
+            info = os.stat(packed)
+            entries.append(('packed-refs', info.st_mtime_ns, info.st_size))
+        for folder, _, files in os.walk(os.path.join(self.root, 'refs')):
+            for name in files:
+                info = os.stat(os.path.join(folder, name))
+                entries.append((os.path.join(folder, name), info.st_mtime_ns, info.st_size))
+        entries.sort()
+        return hashlib.sha1(repr(entries).encode('utf-8')).hexdigest()
+
+    def update(self, names, resolve):
+        '''Refresh the snapshot if the reference database changed.
+        `resolve(name, previous)` returns [target, commit time] of a
+        reference given its previously snapshotted entry (or None).'''
+        with self.lock:
+            fingerprint = self.current_fingerprint()
+            if fingerprint == self.fingerprint:
+                return
+            refs = {}
+            for name in names():
+                refs[name] = resolve(name, self.refs.get(name))
+            self.fingerprint, self.refs = fingerprint, refs
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'refs': refs}, f)
+            os.replace(temporary, self.path)
+
+    def items(self):
+        return [(name, commit_time) for name, (_, commit_time) in self.refs.items()]
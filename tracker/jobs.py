@@ -0,0 +1,236 @@
+# pylint: disable=C0103,C0111
+
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain
+from threading import Lock, BoundedSemaphore
+from uuid import uuid4
+import os
+
+from tracker import app
+from .models import db, User, Tag, Repository, Mirror
+from .git import GitOperations, GitException
+from .cache import invalidate
+
+class Job(object):
+    '''A unit of background work and its observable state.'''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    def __init__(self, user_id, kind):
+        self.id = uuid4().hex
+        self.user_id = user_id
+        self.kind = kind
+        self.state = Job.QUEUED
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now()
+        self.updated_at = datetime.now()
+
+    def __repr__(self):
+        return '<Job %r (%r)>' % (self.id, self.state)
+
+    def update_progress(self, stats):
+        '''Transfer progress callback for pygit2 remotes.'''
+        self.progress = {'received_objects': stats.received_objects,
+                         'indexed_objects': stats.indexed_objects,
+                         'total_objects': stats.total_objects,
+                         'received_bytes': stats.received_bytes}
+        self.updated_at = datetime.now()
+
+    def as_dict(self):
+        return {'id': self.id,
+                'kind': self.kind,
+                'state': self.state,
+                'progress': self.progress,
+                'result': self.result,
+                'error': self.error,
+                'created_at': self.created_at,
+                'updated_at': self.updated_at}
+
+class JobQueue(object):
+    '''Runs jobs on a bounded pool of worker threads (CLONE_CONCURRENCY).
+    Jobs live in memory; only the most recent ones are remembered.'''
+
+    history = 1000
+
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.executor = None
+        self.clone_slots = None
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                workers = app.config.get('CLONE_CONCURRENCY', 2)
+                self.executor = ThreadPoolExecutor(max_workers=workers)
+            return self.executor
+
+    def get_clone_slots(self):
+        '''Every clone or fetch made by a job takes one of CLONE_CONCURRENCY
+        slots, so jobs that clone in parallel (imports) stay within it.'''
+        with self.lock:
+            if self.clone_slots is None:
+                slots = app.config.get('CLONE_CONCURRENCY', 2)
+                self.clone_slots = BoundedSemaphore(slots)
+            return self.clone_slots
+
+    def submit(self, user, kind, func, *args):
+        '''Queue `func(job, *args)`; its return value becomes the result.'''
+        job = Job(user.id, kind)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > JobQueue.history:
+                self.jobs.popitem(last=False)
+        self.get_executor().submit(self.run, job, func, args)
+        return job
+
+    @staticmethod
+    def run(job, func, args):
+        job.state = Job.RUNNING
+        try:
+            job.result = func(job, *args)
+            job.state = Job.FINISHED
+        except GitException as ge:
+            job.error = ge.args[0][0]
+            job.state = Job.FAILED
+        except Exception as e: # pylint: disable=W0703
+            app.logger.exception('job %s failed', job.id)
+            job.error = str(e)
+            job.state = Job.FAILED
+        finally:
+            db.session.remove()
+            job.updated_at = datetime.now()
+
+    def get(self, job_id, user):
+        job = self.jobs.get(job_id)
+        if job and job.user_id == user.id:
+            return job
+        return None
+
+queue = JobQueue()
+
+# number of imported repositories written per transaction.
+import_batch_size = 50
+
+def clone_repository(job, user_id, location, tag_names=None, mode=GitOperations.FULL):
+    '''Clone `location` for the user, index it and apply `tag_names`.'''
+    user = User.query.get(user_id)
+    with queue.get_clone_slots():
+        repository = GitOperations.create_repository(user, location, job.update_progress, mode)
+    repository.update_commit_info()
+    for tag_name in tag_names or []:
+        tag = user.tags.filter_by(name=tag_name).first() or Tag(user, tag_name).save()
+        repository.tags.append(tag)
+    repository.save()
+    invalidate(user_id)
+    return {'repository': repository.id}
+
+def import_repositories(job, user_id, rows):
+    '''Import validated (location, tag names) rows. Existing repositories
+    and tags are resolved with set-based queries, new repositories are
+    cloned in parallel and their rows are written in batches. The result
+    reports the outcome of every row.'''
+    user = User.query.get(user_id)
+    locations = [location for location, _ in rows]
+    existing = {repository.location: repository for repository in
+                user.repositories.filter(Repository.location.in_(locations))}
+    taken = set(name for (name,) in user.repositories.with_entities(Repository.name))
+    tag_names = set(chain.from_iterable(names for _, names in rows))
+    tags = {tag.name: tag for tag in user.tags.filter(Tag.name.in_(tag_names))}
+    for tag_name in tag_names.difference(tags):
+        tags[tag_name] = Tag(user, tag_name)
+        db.session.add(tags[tag_name])
+
+    results, clones = [], []
+    for number, (location, names) in enumerate(rows, 1):
+        result = {'row': number, 'location': location, 'status': 'exists',
+                  'repository': None, 'error': None}
+        results.append(result)
+        if location in existing:
+            repository = existing[location]
+            for tag_name in names:
+                if tags[tag_name] not in repository.tags:
+                    repository.tags.append(tags[tag_name])
+            result['repository'] = repository.id
+            continue
+        git_user, git_name = GitOperations.git_uri_parse(location)
+        if git_name in taken:
+            result.update(status='failed', error='Given repository already exists.')
+            continue
+        taken.add(git_name)
+        creds = GitOperations.get_credentials(git_user, user)
+        clones.append((result, git_user, git_name, creds, names))
+    db.session.commit()
+
+    def clone(entry):
+        result, _, _, creds, _ = entry
+        try:
+            with queue.get_clone_slots():
+                GitOperations.mirror(result['location'], creds)
+            return True
+        except GitException as ge:
+            result.update(status='failed', error=ge.args[0][0])
+            return False
+
+    job.progress = {'rows': len(rows), 'cloned': 0, 'written': 0}
+    # the clone slots, shared with every other job, bound the clones.
+    workers = app.config.get('CLONE_CONCURRENCY', 2)
+    cloned = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry, success in zip(clones, executor.map(clone, clones)):
+            if success:
+                cloned.append(entry)
+                job.progress['cloned'] += 1
+
+    created = []
+    for i in range(0, len(cloned), import_batch_size):
+        batch = cloned[i:i + import_batch_size]
+        # the mirrors' locks keep concurrent clone jobs from inserting or
+        # counting the same mirror; taken in a fixed order.
+        keys = set(GitOperations.mirror_key(entry[0]['location']) for entry in batch)
+        paths = sorted(GitOperations.get_mirror_location(key) for key in keys)
+        with ExitStack() as stack:
+            for path in paths:
+                stack.enter_context(GitOperations.clone_lock(path))
+            for result, git_user, git_name, creds, names in batch:
+                if user.repositories.filter_by(name=git_name).first():
+                    # added by another job since the import started.
+                    result.update(status='failed', error='Given repository already exists.')
+                    continue
+                if not os.path.exists(GitOperations.get_mirror_location(
+                        GitOperations.mirror_key(result['location']))):
+                    # the mirror's last repository was deleted since the clone.
+                    try:
+                        GitOperations.update_mirror(result['location'], creds)
+                    except GitException as ge:
+                        result.update(status='failed', error=ge.args[0][0])
+                        continue
+                repository = Repository(user, git_user, git_name, result['location'])
+                repository.mirror = Mirror.acquire(result['location'])
+                repository.tags.extend(tags[tag_name] for tag_name in names)
+                db.session.add(repository)
+                created.append((result, repository))
+            db.session.commit()
+        job.progress['written'] = len(created)
+    for result, repository in created:
+        result['repository'] = repository.id
+        try:
+            repository.update_commit_info()
+            result['status'] = 'created'
+        except GitException as ge:
+            db.session.rollback()
+            result.update(status='failed', error=ge.args[0][0])
+        except Exception as e: # pylint: disable=W0703
+            db.session.rollback()
+            app.logger.exception('failed to index repository %d', repository.id)
+            result.update(status='failed', error=str(e))
+    invalidate(user_id)
+    return {'rows': results}
@@ -4,14 +4,42 @@ from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy, orm
 from flask.ext.login import UserMixin
 from datetime import datetime
+from collections import Counter, defaultdict
+from itertools import islice
+import json
+import shutil
+from pygit2 import Oid
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from .util import slugify
-from .git import GitMixin
+from .git import GitMixin, GitOperations
+from .index import CommitIndex
+from .cache import numstat_stats, tree_stats, path_stats, repository_pool
 from tracker import app
 
 db = SQLAlchemy(app)
 
+def commit_shared(model, oids, *criteria):
+    '''Commit the rows of `oids` just added to `model`, a table shared by
+    every clone. A concurrent lookup may have stored the same rows first;
+    they hold the same values, so the ones pending here are dropped once
+    the stored ones (matching `criteria`) are found. Any other integrity
+    error is logged. Lookups commit the caller's changes before adding
+    rows, so a rollback only drops these.'''
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        oids = list(set(oids))
+        stored = 0
+        for i in range(0, len(oids), CommitStat.chunk_size):
+            chunk = oids[i:i + CommitStat.chunk_size]
+            stored += db.session.query(model.oid).filter(model.oid.in_(chunk), *criteria) \
+                                .distinct().count()
+        if stored < len(oids):
+            app.logger.exception('failed to store %d %s rows', len(oids), model.__name__)
+
 def init_db():
     # create the tables if it doesn't already exist.
     db.create_all()
@@ -54,6 +82,13 @@ class User(SessionMixin, UserMixin, db.Model):
         for email in emails:
             user_email = UserEmail(self, email).save()
             self.emails.append(user_email)
+        self.update_activity()
+
+    def update_activity(self):
+        '''Recount the daily activity rollups after the emails changed.'''
+        for repository in self.repositories:
+            repository.update_commit_info(recount=True)
+        db.session.commit()
 
     def check_password(self, password):
         return check_password_hash(self.password, password)
@@ -86,6 +121,52 @@ class UserEmail(SessionMixin, db.Model): #pylint: disable-msg=R0903
     def __repr__(self):
         return '<Email %r for %r>' % (self.email, self.user)
 
+class Mirror(SessionMixin, db.Model): #pylint: disable-msg=R0903
+    '''A bare clone shared by every repository, of any user, that tracks
+    the same remote. `refcount` counts those repositories.'''
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False, unique=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(), nullable=False)
+    updated_at = db.Column(db.DateTime(), nullable=False)
+
+    def __init__(self, key):
+        self.key = key
+        self.refcount = 0
+        self.created_at = datetime.now()
+        self.updated_at = datetime.now()
+
+    def __repr__(self):
+        return '<Mirror %r (%r)>' % (self.key, self.refcount)
+
+    def get_path(self):
+        return GitOperations.get_mirror_location(self.key)
+
+    @staticmethod
+    def acquire(git_repo, mode=GitOperations.FULL):
+        '''Take a reference on the mirror of `git_repo`. The caller commits.'''
+        key = GitOperations.mirror_key(git_repo, mode)
+        mirror = Mirror.query.filter_by(key=key).first()
+        if mirror is None:
+            mirror = Mirror(key)
+            db.session.add(mirror)
+        mirror.refcount += 1
+        return mirror
+
+    def release(self):
+        '''Drop a reference; the last one removes the clone from disk. Like
+        acquire, the caller holds the mirror's lock and commits.'''
+        db.session.refresh(self)
+        self.refcount -= 1
+        if self.refcount > 0:
+            self.updated_at = datetime.now()
+            return
+        path = self.get_path()
+        repository_pool.pop(path)
+        CommitIndex.close(path)
+        shutil.rmtree(path, ignore_errors=True)
+        db.session.delete(self)
+
 tags = db.Table('tags',
                 db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
                 db.Column('repository_id', db.Integer, db.ForeignKey('repository.id')))
@@ -105,21 +186,31 @@ class Repository(SessionMixin, GitMixin, db.Model): #pylint: disable-msg=R0904
                            backref=db.backref('repositories',
                                               cascade='all,delete',
                                               lazy='dynamic'))
+    mirror_id = db.Column(db.Integer, db.ForeignKey('mirror.id'))
+    mirror = db.relationship('Mirror')
     git_user = db.Column(db.String(255), nullable=False)
     name = db.Column(db.String(255), nullable=False)
     kind = db.Column(db.String(255), nullable=False) # GITHUB, BITBUCKET, LOCAL
     location = db.Column(db.String(255), nullable=False)
+    mode = db.Column(db.String(255), nullable=False, default=GitOperations.FULL)
     first_commit = db.Column(db.DateTime())
     last_commit = db.Column(db.DateTime())
+    indexed_refs = db.Column(db.Text()) # json: tracked ref -> last indexed oid
+    refspecs = db.Column(db.Text()) # json: fetched refspecs, null for the defaults
+    branches = db.Column(db.Text()) # json: tracked branch patterns, null for the default branch
+    next_refresh = db.Column(db.DateTime())
+    refresh_failures = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime(), nullable=False)
     updated_at = db.Column(db.DateTime(), nullable=False)
 
-    def __init__(self, user, git_user, name, location):
+    def __init__(self, user, git_user, name, location, mode=GitOperations.FULL):
         self.user_id = user.id
         self.git_user = git_user
         self.name = name
         self.location = location
+        self.mode = mode
         self.kind = Repository.LOCAL
+        self.refresh_failures = 0
         if 'github' in location:
             self.kind = Repository.GITHUB
         if 'bitbucket' in location:
@@ -127,16 +218,112 @@ class Repository(SessionMixin, GitMixin, db.Model): #pylint: disable-msg=R0904
         self.created_at = datetime.now()
         self.updated_at = datetime.now()
 
-    def update_commit_info(self):
-        self.reconstruct()
-        self.first_commit = datetime.fromtimestamp(self.get_first_updated())
-        self.last_commit = datetime.fromtimestamp(self.get_last_updated())
+    def get_numstats(self, commits):
+        return CommitStat.lookup(self, commits)
+
+    def get_churn(self, start=None, end=None, depth=1, prefix=''):
+        '''Churn per directory of the user's commits between `start` and
+        `end`. Commits whose path stats are unknown (metadata-only clones)
+        are counted but left out.'''
+        commits = self.commits_between(start, end)
+        counts = {'commit_count': 0, 'unknown': 0}
+        def path_stats():
+            while True:
+                batch = list(islice(commits, CommitStat.chunk_size))
+                if not batch:
+                    return
+                known = PathStat.lookup(self, batch)
+                counts['commit_count'] += len(batch)
+                counts['unknown'] += len(batch) - len(known)
+                for stats in known.values():
+                    yield stats
+        churn = GitMixin.churn(path_stats(), depth, prefix)
+        return dict(counts, directories=churn)
+
+    def get_tree_stats(self, previous=None):
+        return TreeStat.lookup(self, self.ondisk.head.get_object().tree, previous)
+
+    def get_refspecs(self):
+        if not self.refspecs:
+            return None
+        return json.loads(self.refspecs)
+
+    def set_refspecs(self, refspecs):
+        self.refspecs = json.dumps(refspecs) if refspecs else None
+
+    def get_fetch_refspecs(self):
+        '''The refspecs of every repository sharing the mirror: a mirror is
+        fetched once per sweep, on behalf of all of them.'''
+        if self.mirror is None:
+            return self.get_refspecs()
+        refspecs = set()
+        query = Repository.query.filter_by(mirror_id=self.mirror_id) \
+                                .with_entities(Repository.refspecs)
+        for (value,) in query:
+            refspecs.update(json.loads(value) if value else GitOperations.default_refspecs)
+        return sorted(refspecs)
+
+    def get_branches(self):
+        if not self.branches:
+            return None
+        return json.loads(self.branches)
+
+    def set_branches(self, branches):
+        self.branches = json.dumps(sorted(set(branches))) if branches else None
+
+    def get_indexed_refs(self):
+        if not self.indexed_refs:
+            return {}
+        return json.loads(self.indexed_refs)
+
+    def update_commit_info(self, recount=False):
+        '''Index the commits added since the last refresh. With `recount`
+        (the user's emails changed) the activity rollups are rebuilt.'''
+        tips = self.get_tips()
+        indexed = self.get_indexed_refs()
+        if tips == indexed and not recount:
+            # nothing moved since the last refresh.
+            return
+        if tips != indexed and not self.ondisk.head_is_unborn:
+            # derive the new tree statistics from the previous HEAD.
+            previous = indexed.get(self.ondisk.head.name)
+            try:
+                previous = self.ondisk[Oid(hex=previous)].tree if previous else None
+            except KeyError: # pragma: no cover
+                previous = None
+            self.get_tree_stats(previous)
+        # the time index only walks the commits added since its last update.
+        index = self.get_index()
+        # the clone may have been fetched again since: count up to the tips
+        # the index was built from.
+        tips = dict(index.refs)
+        if len(index):
+            self.first_commit = datetime.fromtimestamp(index.first())
+            self.last_commit = datetime.fromtimestamp(index.last())
+        walker, incremental = None, False
+        if indexed and tips and not recount:
+            walker, incremental = self.walk_since(indexed, tips)
+        if incremental:
+            emails = set(self.get_emails())
+            DailyActivity.add(self, Counter(GitMixin.by_day(commit) for commit in walker
+                                            if commit.author.email in emails))
+            self.indexed_refs = json.dumps(tips)
+        else:
+            DailyActivity.rebuild(self)
         self.save()
 
-    # initialize GitMixin
-    @orm.reconstructor
-    def reconstruct(self):
-        GitMixin.__init__(self)
+    def delete(self):
+        mirror = self.mirror
+        if mirror is None:
+            self.release()
+            SessionMixin.delete(self)
+            return
+        # concurrent clones of the remote must neither fetch into a mirror
+        # that is being removed nor take a reference on it.
+        with GitOperations.clone_lock(mirror.get_path()):
+            db.session.delete(self)
+            mirror.release()
+            db.session.commit()
 
     def clear_tags(self):
         query = tags.delete().where(tags.c.repository_id == self.id)
@@ -169,3 +356,269 @@ class Tag(SessionMixin, db.Model): #pylint: disable-msg=R0903
 
     def __repr__(self):
         return '<Tag %r>' % self.name
+
+class CommitStat(db.Model): #pylint: disable-msg=R0903
+    '''Numstat (files changed, additions, deletions) of a commit against
+    its first parent. Commits are immutable so this is keyed by oid alone.'''
+    oid = db.Column(db.String(40), primary_key=True)
+    changed_files = db.Column(db.Integer, nullable=False)
+    additions = db.Column(db.Integer, nullable=False)
+    deletions = db.Column(db.Integer, nullable=False)
+    # whether the PathStat rows of the commit are complete.
+    has_paths = db.Column(db.Boolean(), nullable=False, default=False)
+
+    # sqlite limits the number of bound parameters per query.
+    chunk_size = 500
+
+    def __init__(self, oid, changed_files, additions, deletions):
+        self.oid = oid
+        self.changed_files = changed_files
+        self.additions = additions
+        self.deletions = deletions
+
+    def __repr__(self):
+        return '<CommitStat %r>' % self.oid
+
+    def as_tuple(self):
+        return (self.changed_files, self.additions, self.deletions)
+
+    @staticmethod
+    def lookup(repository, commits):
+        '''Numstats for `commits`, diffing only those not seen before.
+        The clone's columnar index is consulted first and written through,
+        the table is shared by every clone.'''
+        commits = list(commits)
+        oids = [str(commit.id) for commit in commits]
+        index = repository.get_index()
+        known, computed = {}, {}
+        for oid, commit in zip(oids, commits):
+            stats = index.get_numstat(commit.commit_time, commit.id.raw)
+            if stats:
+                known[oid] = stats
+        missing = [oid for oid in oids if oid not in known]
+        stored = {}
+        for i in range(0, len(missing), CommitStat.chunk_size):
+            chunk = missing[i:i + CommitStat.chunk_size]
+            query = CommitStat.query.filter(CommitStat.oid.in_(chunk))
+            stored.update((stat.oid, stat.as_tuple()) for stat in query)
+        numstat_stats.hit(len(known) + len(stored))
+        for oid, commit in zip(oids, commits):
+            if oid in known:
+                continue
+            if oid in stored:
+                known[oid] = stored[oid]
+            elif not repository.has_blobs():
+                # nothing to diff; another clone of the remote may fill it in.
+                known[oid] = repository.get_numstat(commit)
+                continue
+            else:
+                known[oid] = computed[oid] = repository.get_numstat(commit)
+                numstat_stats.miss()
+            index.set_numstat(commit.commit_time, commit.id.raw, known[oid])
+        if computed:
+            db.session.commit()
+            with db.session.no_autoflush:
+                for oid, stats in computed.items():
+                    db.session.merge(CommitStat(oid, *stats))
+            commit_shared(CommitStat, computed)
+        return [known[oid] for oid in oids]
+
+class PathStat(db.Model): #pylint: disable-msg=R0903
+    '''Lines added and deleted in one file by a commit against its first
+    parent. Like CommitStat, this is keyed by oid and shared by every clone.'''
+    oid = db.Column(db.String(40), primary_key=True)
+    path = db.Column(db.String(1024), primary_key=True)
+    additions = db.Column(db.Integer, nullable=False)
+    deletions = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, oid, path, additions, deletions):
+        self.oid = oid
+        self.path = path
+        self.additions = additions
+        self.deletions = deletions
+
+    def __repr__(self):
+        return '<PathStat %r %r>' % (self.oid, self.path)
+
+    def as_tuple(self):
+        return (self.path, self.additions, self.deletions)
+
+    @staticmethod
+    def lookup(repository, commits):
+        '''Path stats of `commits` by oid, diffing only those not seen
+        before. A commit's rows are complete once its CommitStat is marked
+        `has_paths`; commits that cannot be diffed (metadata-only clones)
+        are left out.'''
+        commits = list(commits)
+        oids = [str(commit.id) for commit in commits]
+        db.session.commit()
+        numstats, paths = {}, defaultdict(list)
+        for i in range(0, len(oids), CommitStat.chunk_size):
+            chunk = oids[i:i + CommitStat.chunk_size]
+            query = CommitStat.query.filter(CommitStat.oid.in_(chunk))
+            numstats.update((stat.oid, stat) for stat in query)
+            complete = [oid for oid in chunk if oid in numstats and numstats[oid].has_paths]
+            if complete:
+                for stat in PathStat.query.filter(PathStat.oid.in_(complete)):
+                    paths[stat.oid].append(stat.as_tuple())
+        known, changed = {}, {}
+        for oid, commit in zip(oids, commits):
+            numstat = numstats.get(oid)
+            if numstat is not None and numstat.has_paths:
+                known[oid] = paths[oid]
+                path_stats.hit()
+                continue
+            if not repository.has_blobs():
+                continue
+            path_stats.miss()
+            diff = repository.get_diff(commit)
+            known[oid] = GitMixin.path_stats(diff)
+            changed[oid] = len(diff)
+        if not changed:
+            return known
+        # rows of an earlier, incomplete attempt.
+        written = list(changed)
+        for i in range(0, len(written), CommitStat.chunk_size):
+            chunk = written[i:i + CommitStat.chunk_size]
+            PathStat.query.filter(PathStat.oid.in_(chunk)).delete(synchronize_session=False)
+        with db.session.no_autoflush:
+            for oid, changed_files in changed.items():
+                db.session.add_all(PathStat(oid, *stats) for stats in known[oid])
+                numstat = numstats.get(oid)
+                if numstat is None:
+                    numstat = db.session.merge(CommitStat(oid, changed_files,
+                                                          sum(stats[1] for stats in known[oid]),
+                                                          sum(stats[2] for stats in known[oid])))
+                numstat.has_paths = True
+        commit_shared(CommitStat, written, CommitStat.has_paths == True)
+        return known
+
+class TreeStat(db.Model): #pylint: disable-msg=R0903
+    '''File and line counts of a tree, keyed by tree oid.'''
+    oid = db.Column(db.String(40), primary_key=True)
+    file_count = db.Column(db.Integer, nullable=False)
+    line_count = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, oid, file_count, line_count):
+        self.oid = oid
+        self.file_count = file_count
+        self.line_count = line_count
+
+    def __repr__(self):
+        return '<TreeStat %r>' % self.oid
+
+    def as_tuple(self):
+        return (self.file_count, self.line_count)
+
+    @staticmethod
+    def lookup(repository, tree, previous=None):
+        '''Counts for `tree`. When the counts of a `previous` tree are
+        known only the difference between both trees is examined.'''
+        stat = TreeStat.query.get(str(tree.id))
+        if stat:
+            tree_stats.hit()
+            return stat.as_tuple()
+        tree_stats.miss()
+        if not repository.has_blobs():
+            return (None, None)
+        known = TreeStat.query.get(str(previous.id)) if previous else None
+        if known:
+            counts = GitMixin.count_tree_change(previous, tree, known.as_tuple())
+        else:
+            counts = GitMixin.count_tree(tree)
+        db.session.commit()
+        db.session.merge(TreeStat(str(tree.id), *counts))
+        commit_shared(TreeStat, [str(tree.id)])
+        return counts
+
+class MaintenanceRun(SessionMixin, db.Model): #pylint: disable-msg=R0903
+    '''Object store metrics of a clone before and after maintenance.'''
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), nullable=False, index=True)
+    repacked = db.Column(db.Boolean(), nullable=False)
+    packs_before = db.Column(db.Integer, nullable=False)
+    loose_before = db.Column(db.Integer, nullable=False)
+    size_before = db.Column(db.Integer, nullable=False)
+    packs_after = db.Column(db.Integer, nullable=False)
+    loose_after = db.Column(db.Integer, nullable=False)
+    size_after = db.Column(db.Integer, nullable=False)
+    duration = db.Column(db.Float(), nullable=False)
+    created_at = db.Column(db.DateTime(), nullable=False)
+    updated_at = db.Column(db.DateTime(), nullable=False)
+
+    def __init__(self, path, repacked, before, after, duration):
+        self.path = path
+        self.repacked = repacked
+        self.packs_before = before['packs']
+        self.loose_before = before['loose']
+        self.size_before = before['size']
+        self.packs_after = after['packs']
+        self.loose_after = after['loose']
+        self.size_after = after['size']
+        self.duration = duration
+        self.created_at = datetime.now()
+        self.updated_at = datetime.now()
+
+    def __repr__(self):
+        return '<MaintenanceRun %r (%r)>' % (self.path, self.repacked)
+
+class DailyActivity(db.Model): #pylint: disable-msg=R0903
+    '''Number of the owner's commits to a repository per day. Days are
+    the timestamps produced by GitMixin.day_of.'''
+    repository_id = db.Column(db.Integer, db.ForeignKey('repository.id'), primary_key=True)
+    repository = db.relationship('Repository',
+                                 backref=db.backref('activity',
+                                                    cascade='all,delete',
+                                                    lazy='dynamic'))
+    day = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, repository, day, count):
+        self.repository_id = repository.id
+        self.day = day
+        self.count = count
+
+    def __repr__(self):
+        return '<DailyActivity %r: %r>' % (self.day, self.count)
+
+    @staticmethod
+    def add(repository, days):
+        '''Add the commits counted in `days` (day -> count).'''
+        if not days:
+            return
+        existing = repository.activity.filter(DailyActivity.day >= min(days))
+        existing = {activity.day: activity for activity in existing}
+        for day, count in days.items():
+            if day in existing:
+                existing[day].count += count
+            else:
+                db.session.add(DailyActivity(repository, day, count))
+
+    @staticmethod
+    def rebuild(repository):
+        '''Recount everything from the time index (no git objects needed).
+        The repository is marked as indexed up to the tips the index was
+        built from, so that the next refresh only adds newer commits.'''
+        repository.activity.delete()
+        index = repository.get_index()
+        with index.lock:
+            tips = dict(index.refs)
+            days = index.day_counts(None, None, repository.get_emails())
+        repository.indexed_refs = json.dumps(tips)
+        if repository.ondisk.head_is_unborn:
+            return
+        db.session.add_all(DailyActivity(repository, day, count)
+                           for day, count in days)
+
+    @staticmethod
+    def histogram(repositories, start=None, end=None):
+        '''Sum the daily counts of a query of repositories.'''
+        ids = repositories.with_entities(Repository.id).subquery()
+        query = db.session.query(DailyActivity.day, db.func.sum(DailyActivity.count)) \
+                          .filter(DailyActivity.repository_id.in_(ids))
+        if start is not None:
+            query = query.filter(DailyActivity.day >= GitMixin.day_of(start))
+        if end is not None:
+            query = query.filter(DailyActivity.day <= GitMixin.day_of(end))
+        query = query.group_by(DailyActivity.day).order_by(DailyActivity.day)
+        return [{'date': day, 'value': int(count)} for day, count in query]
@@ -1,25 +1,72 @@
 #!/usr/bin/env python
 # pylint: disable=C0103,C0111,W0142
 
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, json, make_response, stream_with_context, abort
 from flask.ext.login import login_required, login_user, logout_user, current_user
 
 from .util import get_gravatar, slugify, save_uploaded_file
-from .models import User, Tag
-from .git import GitOperations, GitException
+from .models import User, Tag, Repository
+from .git import GitOperations, GitException, GitMixin
 from .data import DataOperations
+from .cache import CacheStats, response_cache, invalidate, generation
+from .jobs import queue, clone_repository, import_repositories
 from tracker import app
 
 from functools import wraps
+from itertools import islice
+from types import GeneratorType
 import io, csv
+import hashlib
+import gzip
 
 def success(result=None):
     if not result:
         return jsonify(success=True)
     return jsonify(success=True, data=result)
 
+def stream_success(result):
+    '''Like success(), but the response is encoded and sent piece by
+    piece: lists and generators in `result` are written out one element
+    at a time, so large responses are never held in memory as a whole.'''
+    def generate():
+        yield '{"success": true, "data": {'
+        for i, (key, value) in enumerate(result.items()):
+            yield (', ' if i else '') + json.dumps(key) + ': '
+            if isinstance(value, (list, GeneratorType)):
+                yield '['
+                for j, item in enumerate(value):
+                    yield (', ' if j else '') + json.dumps(item)
+                yield ']'
+            else:
+                yield json.dumps(value)
+        yield '}}'
+    return app.response_class(stream_with_context(generate()),
+                              mimetype='application/json')
+
+COMPACT_MIMETYPE = 'application/vnd.git-tracker.compact+json'
+
+def wants_compact():
+    return request.args.get('histogram') == 'compact' or \
+        any(value == COMPACT_MIMETYPE for value, _ in request.accept_mimetypes)
+
+def encode_histogram(histogram, resolution):
+    if wants_compact():
+        return GitMixin.compact(histogram, resolution)
+    return histogram
+
+def respond(result):
+    if request.args.get('stream'):
+        return stream_success(result)
+    response = success(result=result)
+    if wants_compact() and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    return response
+
 def failure(error, code=None):
-    response = jsonify(success=False, errors=[error])
+    errors = error if isinstance(error, list) else [error]
+    response = jsonify(success=False, errors=errors)
     response.status_code = code or 422
     return response
 
@@ -33,6 +80,53 @@ def jsoncheck(func):
             return failure(str(''.join(e.args)) + ' not found', code=400)
     return wrapper
 
+def clone_state(repositories):
+    '''State of views read from the clones: their current tips.'''
+    return tuple((r.id, r.updated_at, tuple(sorted(r.get_tips().items())))
+                 for r in repositories)
+
+def rollup_state(repositories):
+    '''State of views answered from the database: what the rollups were
+    last built from. A single query, git is not touched.'''
+    return tuple(repositories.with_entities(Repository.id, Repository.updated_at,
+                                            Repository.indexed_refs)
+                             .order_by(Repository.id))
+
+def cached(get_state):
+    '''Serve a view from the response cache. A response is a function of
+    the user (emails, tags), the state of the involved repositories
+    (`get_state(*args)`) and the query, which also make up its ETag.'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            state = get_state(*args, **kwargs)
+            emails = tuple(sorted(ue.email for ue in current_user.emails))
+            key = (request.path, tuple(sorted(request.args.items(multi=True))),
+                   request.headers.get('Accept'), request.headers.get('Accept-Encoding'),
+                   current_user.id, generation(current_user.id), emails, state)
+            etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+            cached_response = response_cache.get(key)
+            if cached_response is None:
+                response = func(*args, **kwargs)
+                if response.is_streamed:
+                    response.set_etag(etag)
+                    return response
+                if response.status_code != 200:
+                    return response
+                headers = [(name, value) for name, value in response.headers
+                           if name in ['Content-Encoding', 'Vary']]
+                cached_response = response_cache.put(key, (response.get_data(), headers))
+            body, headers = cached_response
+            response = app.response_class(body, mimetype='application/json', headers=headers)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
 @app.route('/login', methods=['POST'])
 @jsoncheck
 def login():
@@ -103,6 +197,7 @@ def add_user_email():
     if current_user.emails.filter_by(email=email).scalar():
         return failure('Current email already exists.')
     current_user.add_emails(email)
+    invalidate(current_user.id)
     return success()
 
 @app.route('/emails/<id>', methods=['DELETE'])
@@ -110,6 +205,8 @@ def add_user_email():
 def delete_user_email(id):
     ue = current_user.emails.filter_by(id=id).first_or_404()
     ue.delete()
+    current_user.update_activity()
+    invalidate(current_user.id)
     return success()
 
 @app.route('/repositories', methods=['GET'])
@@ -127,62 +224,99 @@ def get_repositories():
 def add_repository():
     try:
         location = request.json['location']
+        mode = request.json.get('mode', GitOperations.FULL)
+        if mode not in GitOperations.modes:
+            return failure('Invalid mode.')
         _, name = GitOperations.git_uri_parse(location)
         if current_user.repositories.filter_by(name=name).scalar():
             return failure('Given repository already exists.')
-        repository = GitOperations.create_repository(current_user, location)
-        repository.save()
-        repository.update_commit_info()
-        return success()
-    except GitException as ge:
+        job = queue.submit(current_user, 'clone', clone_repository,
+                           current_user.id, location, None, mode)
+        return success(result={'job': job.id})
+    except GitException as ge: # pragma: no cover
         return failure(ge.args[0][0])
 
+def commit_details(repository, commits, chunk=100):
+    '''Yield the details of `commits`, looking numstats up a chunk at a time.'''
+    while True:
+        batch = list(islice(commits, chunk))
+        if not batch:
+            return
+        numstats = repository.get_numstats(batch)
+        for commit, (changed_files, additions, deletions) in zip(batch, numstats):
+            yield dict(commit_time=commit.commit_time,
+                       author_name=commit.author.name,
+                       message=commit.message,
+                       changed_files=changed_files,
+                       additions=additions,
+                       deletions=deletions)
+
 @app.route('/repositories/<id>', methods=['GET'])
 @login_required
+@cached(lambda id: clone_state(current_user.repositories.filter_by(id=id)))
 def view_repository(id):
     repository = current_user.repositories.filter_by(id=id).first_or_404()
-    first_updated = repository.get_first_updated()
-    last_updated = repository.get_last_updated()
-    start = int(request.args.get('start', first_updated))
-    end = int(request.args.get('end', last_updated))
-    histogram = repository.histogram(start, end)
+    resolution = request.args.get('resolution', 'day')
+    if resolution not in GitMixin.resolutions:
+        return failure('Invalid resolution.', code=400)
+    start = request.args.get('start')
+    start = int(start) if start else None
+    end = request.args.get('end')
+    end = int(end) if end else None
+    commit_count = request.args.get('commit_count')
+    commit_count = int(commit_count) if commit_count else None
+    try:
+        latest, next_cursor = repository.get_commit_page(commit_count,
+                                                         request.args.get('cursor'))
+    except ValueError:
+        return failure('Invalid cursor.', code=400)
+    statistics = repository.get_statistics(start, end)
     reference_count = request.args.get('reference_count')
     reference_count = int(reference_count) if reference_count else None
     references = [ref for ref in repository.get_latest_refs(count=reference_count)]
-    commit_count = request.args.get('commit_count')
-    commit_count = int(commit_count) if commit_count else None
-    commits = []
-    for commit in repository.get_commits(count=commit_count):
-        changed_files, additions, deletions = repository.get_numstat(commit)
-        commits.append(dict(commit_time=commit.commit_time,
-                            author_name=commit.author.name,
-                            message=commit.message,
-                            changed_files=changed_files,
-                            additions=additions,
-                            deletions=deletions))
-    commit_count = repository.get_commit_count()
-    author_count = repository.get_author_count()
-    file_count = repository.get_file_count()
-    line_count = repository.get_line_count()
-    identifier = repository.get_shorthand_of_branch('master')
-    sha1 = repository.get_sha1_of_branch('master')
+    commits = commit_details(repository, latest)
+    if not request.args.get('stream'):
+        commits = list(commits)
+    branch = repository.get_default_branch()
+    identifier = repository.get_shorthand_of_branch(branch)
+    sha1 = repository.get_sha1_of_branch(branch)
     tags = current_user.tags.order_by('name').all()
     result= {'kind': repository.kind,
              'name': repository.name,
-             'first_updated': first_updated,
-             'last_updated': last_updated,
-             'histogram': histogram,
+             'first_updated': statistics['first_updated'],
+             'last_updated': statistics['last_updated'],
+             'histogram': encode_histogram(GitMixin.rebucket(statistics['histogram'],
+                                                             resolution),
+                                           resolution),
              'updated': repository.updated_at,
              'git_identifier': identifier,
              'git_sha1': sha1,
+             'mode': repository.mode,
+             'branches': repository.get_branches(),
              'references': references,
              'commits': commits,
-             'commit_count': commit_count,
-             'author_count': author_count,
-             'file_count': file_count,
-             'line_count': line_count,
+             'next_cursor': next_cursor,
+             'commit_count': statistics['commit_count'],
+             'author_count': statistics['author_count'],
+             'file_count': statistics['file_count'],
+             'line_count': statistics['line_count'],
              'tags': tags}
-    return success(result=result)
+    return respond(result)
+
+@app.route('/repositories/<id>/churn', methods=['GET'])
+@login_required
+@cached(lambda id: clone_state(current_user.repositories.filter_by(id=id)))
+def view_churn(id):
+    repository = current_user.repositories.filter_by(id=id).first_or_404()
+    start = request.args.get('start')
+    start = int(start) if start else None
+    end = request.args.get('end')
+    end = int(end) if end else None
+    depth = request.args.get('depth', '1')
+    if not depth.isdigit() or int(depth) < 1:
+        return failure('Invalid depth.', code=400)
+    churn = repository.get_churn(start, end, int(depth), request.args.get('prefix', ''))
+    return respond(churn)
 
 @app.route('/repositories/<id>', methods=['PUT'])
 @jsoncheck
@@ -195,6 +329,7 @@ def apply_tags(id):
         tag = current_user.tags.filter_by(id=tag_id).first_or_404()
         repository.tags.append(tag)
     repository.save()
+    invalidate(current_user.id)
     return success()
 
 @app.route('/repositories/<id>', methods=['DELETE'])
@@ -203,8 +338,37 @@ def delete_repository(id):
     repository = current_user.repositories.filter_by(id=id).first_or_404()
     repository.clear_tags()
     repository.delete()
+    invalidate(current_user.id)
     return success()
 
+@app.route('/repositories/<id>/refspecs', methods=['PUT'])
+@jsoncheck
+@login_required
+def set_refspecs(id):
+    repository = current_user.repositories.filter_by(id=id).first_or_404()
+    refspecs = request.json['refspecs']
+    if not all(GitOperations.valid_refspec(refspec) for refspec in refspecs):
+        return failure('Invalid refspecs.')
+    repository.set_refspecs(refspecs)
+    repository.save()
+    return success(result={'refspecs': repository.get_refspecs()})
+
+@app.route('/repositories/<id>/branches', methods=['PUT'])
+@jsoncheck
+@login_required
+def set_branches(id):
+    repository = current_user.repositories.filter_by(id=id).first_or_404()
+    branches = request.json['branches']
+    if not isinstance(branches, list) or \
+       not all(isinstance(branch, str) and branch for branch in branches):
+        return failure('Invalid branches.')
+    repository.set_branches(branches)
+    repository.update_commit_info()
+    repository.save()
+    invalidate(current_user.id)
+    return success(result={'branches': repository.get_branches(),
+                           'tracked_refs': repository.get_tracked_refs()})
+
 @app.route('/tags', methods=['GET'])
 @login_required
 def get_tags():
@@ -226,15 +390,24 @@ def add_tag():
     if current_user.tags.filter_by(slug=slugify(name)).scalar():
         return failure('Given tag slug already exists.')
     tag = Tag(current_user, name).save()
+    invalidate(current_user.id)
     return success()
 
+def tag_state(id):
+    tag = current_user.tags.filter_by(id=id).first()
+    return rollup_state(tag.repositories) if tag else ()
+
 @app.route('/tags/<id>', methods=['GET'])
 @login_required
+@cached(tag_state)
 def view_tag(id):
     start = request.args.get('start', None)
     end = request.args.get('end', None)
+    resolution = request.args.get('resolution', 'day')
+    if resolution not in GitMixin.resolutions:
+        return failure('Invalid resolution.', code=400)
     tag = current_user.tags.filter_by(id=id).first_or_404()
-    ops = DataOperations(tag.repositories, start=start, end=end)
+    ops = DataOperations(tag.repositories, start=start, end=end, resolution=resolution)
     result = {'repositories': [repo.id for repo in tag.repositories],
               'repository_count': tag.repositories.count(),
               'slug': tag.slug,
@@ -242,35 +415,47 @@ def view_tag(id):
               'id': tag.id,
               'first_updated': ops.first_updated,
               'last_updated': ops.last_updated,
-              'histogram': ops.histogram}
-    return success(result=result)
+              'histogram': encode_histogram(ops.histogram, resolution)}
+    return respond(result)
 
 @app.route('/tags/<id>', methods=['DELETE'])
 @login_required
 def delete_tag(id):
     tag = current_user.tags.filter_by(id=id).first_or_404()
     tag.delete()
+    invalidate(current_user.id)
     return success()
 
 @app.route('/activity', methods=['GET'])
 @login_required
+@cached(lambda: rollup_state(current_user.repositories))
 def activity():
     start = request.args.get('start', None)
     end = request.args.get('end', None)
-    ops = DataOperations(current_user.repositories, start=start, end=end)
+    resolution = request.args.get('resolution', 'day')
+    if resolution not in GitMixin.resolutions:
+        return failure('Invalid resolution.', code=400)
+    ops = DataOperations(current_user.repositories, start=start, end=end,
+                         resolution=resolution)
     result = {'first_updated': ops.first_updated,
               'last_updated': ops.last_updated,
-              'histogram': ops.histogram}
-    return success(result=result)
+              'histogram': encode_histogram(ops.histogram, resolution)}
+    return respond(result)
 
 @app.route('/actions/refresh/<id>', methods=['GET'])
 @login_required
 def refresh_repository(id):
     repository = current_user.repositories.filter_by(id=id).first_or_404()
-    repository.refresh()
+    transfer = repository.refresh()
     repository.update_commit_info()
     repository.save()
-    return success()
+    invalidate(current_user.id)
+    return success(result={'transfer': transfer})
+
+@app.route('/actions/stats', methods=['GET'])
+@login_required
+def cache_stats():
+    return success(result=CacheStats.report())
 
 @app.route('/actions/dump', methods=['GET'])
 @login_required
@@ -294,26 +479,28 @@ def load_repositories():
     if not csv_file.filename:
         return failure('No file uploaded.')
     csv_path = save_uploaded_file(current_user, csv_file, app.config['UPLOAD_FOLDER'])
-    with open(csv_path, 'r+') as f:
-        for line in csv.reader(f):
+    # validate everything before doing any work.
+    rows, errors = [], []
+    with open(csv_path, 'r') as f:
+        for number, line in enumerate(csv.reader(f), 1):
             if not (isinstance(line, list) and len(line) == 4):
-                return failure('Invalid format.')
+                errors.append('Row %d: expected 4 columns.' % number)
+                continue
             [_, location, _, tags] = line
-            # create the repository if not already extant.
-            has_repository = current_user.repositories.filter_by(location=location)
-            if not has_repository.all():
-                repository = GitOperations.create_repository(current_user, location)
-                repository.save()
-                repository.update_commit_info()
-            else:
-                repository = has_repository.first()
-            # apply tags if not already extant.
-            for tag_name in tags.split(','):
-                tag_name = tag_name.strip()
-                if not tag_name:
-                    continue
-                has_tag = current_user.tags.filter_by(name=tag_name)
-                tag = has_tag.first() if has_tag.all() else Tag(current_user, tag_name).save()
-                if repository.tags.count(tag) == 0:
-                    repository.tags.append(tag)
-    return success()
+            if not location.strip():
+                errors.append('Row %d: missing location.' % number)
+                continue
+            tag_names = [tag_name.strip() for tag_name in tags.split(',') if tag_name.strip()]
+            rows.append((location.strip(), tag_names))
+    if errors:
+        return failure(['Invalid format.'] + errors)
+    job = queue.submit(current_user, 'import', import_repositories, current_user.id, rows)
+    return success(result={'job': job.id})
+
+@app.route('/jobs/<id>', methods=['GET'])
+@login_required
+def view_job(id):
+    job = queue.get(id, current_user)
+    if not job:
+        abort(404)
+    return success(result=job.as_dict())